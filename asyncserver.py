@@ -0,0 +1,122 @@
+"""
+An asyncio server engine, an alternative to PodSixNet's Pump loop.
+
+The event loop waits on epoll instead of busy-polling asyncore, so idle
+connections cost no CPU and the number of clients isn't capped by
+select()'s FD_SETSIZE. Clients talk the same rencoded PodSixNet protocol
+and are handled by the same Network_* handlers as ClientChannel. Rooms
+tick from a task of the same event loop.
+"""
+import asyncio
+import logging
+import socket
+
+from PodSixNet.rencode import dumps, loads
+
+from scheduler import AsyncRoomScheduler
+from server import BombermanServerBase, ClientChannelHandlers
+
+log = logging.getLogger(__name__)
+
+
+class AsyncChannel(asyncio.Protocol):
+    """
+    The asyncio counterpart of PodSixNet's Channel.
+    """
+
+    endchars = b'\0---\0'
+
+    def __init__(self, server):
+        self._server = server
+        self._ibuffer = bytearray()
+        self.transport = None
+        self.addr = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.Send({"action": "connected"})
+        self._server.Connected(self, self.addr)
+
+    def data_received(self, data):
+        self._ibuffer += data
+
+        while True:
+            end = self._ibuffer.find(self.endchars)
+            if end < 0:
+                return
+
+            message = loads(bytes(self._ibuffer[:end]))
+            del self._ibuffer[:end + len(self.endchars)]
+            self.found_message(message)
+
+    def found_message(self, data):
+        if type(data) is dict and 'action' in data:
+            for name in ('Network_' + data['action'], 'Network'):
+                if hasattr(self, name):
+                    getattr(self, name)(data)
+        else:
+            log.warning("OOB data: %r", data)
+
+    def connection_lost(self, exc):
+        if hasattr(self, "Close"):
+            self.Close()
+
+    def Send(self, data):
+        """Returns the number of bytes sent after encoding."""
+        outgoing = dumps(data) + self.endchars
+        self.SendBytes(outgoing)
+        return len(outgoing)
+
+    def SendBytes(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+
+class AsyncClientChannel(ClientChannelHandlers, AsyncChannel):
+
+    def __init__(self, server):
+        ClientChannelHandlers.__init__(self)
+        AsyncChannel.__init__(self, server)
+
+
+class AsyncBombermanServer(BombermanServerBase):
+
+    scheduler_class = AsyncRoomScheduler
+    channelClass = AsyncClientChannel
+
+    def __init__(self, localaddr=("127.0.0.1", 5071), listeners=1024, metrics=None, recordings=None,
+                 slow_client_timeout=None):
+        BombermanServerBase.__init__(self, metrics, recordings, slow_client_timeout)
+        self.localaddr = localaddr
+        self.listeners = listeners
+
+        log.info('Server launched')
+
+    def OutboundQueueBytes(self, player):
+        if player.transport is None:
+            return 0
+        return player.transport.get_write_buffer_size()
+
+    def DisconnectPlayer(self, player):
+        # the rooms tick on the event loop, which owns the transports
+        if player.transport is not None and not player.transport.is_closing():
+            player.transport.abort()
+
+    async def serve(self):
+        host, port = self.localaddr
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: self.channelClass(self), host, port,
+                                          backlog=self.listeners, reuse_address=True)
+        self.scheduler.start()
+
+        async with server:
+            await server.serve_forever()
+
+    def Launch(self):
+        asyncio.run(self.serve())
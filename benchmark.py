@@ -0,0 +1,326 @@
+"""
+Benchmarks of the game engine and the server.
+
+    python3 benchmark.py --output before.json
+    python3 benchmark.py --output after.json --compare before.json
+
+Every benchmark reports how many operations (calls, ticks or frames - see
+`unit`) run per second and the p50/p99 latency of a single operation.
+The server scenario drives a BombermanServer with loopback clients and
+also reports the bytes sent per frame.
+"""
+import argparse
+import json
+import platform
+import random
+import threading
+import time
+
+from game import Bomb, Board, Game, Player, StringRenderer
+
+SIZES = {
+    'default': (Game.WIDTH, Game.HEIGHT),
+    'large': (512, 256),
+}
+
+
+def summarize(durations, number=1, unit='call'):
+    """
+    :param durations: durations of the samples, in seconds
+    :param number: operations per sample
+    :return: a dict with the throughput and latency percentiles
+    """
+    latencies = sorted(duration / number for duration in durations)
+    total = sum(durations)
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    return {
+        'unit': unit,
+        'count': len(latencies) * number,
+        'per_second': len(latencies) * number / total if total else 0.0,
+        'mean': total / (len(latencies) * number),
+        'p50': percentile(0.5),
+        'p99': percentile(0.99),
+    }
+
+
+def time_samples(function, repeat, number=1):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def measure(function, repeat, number=1, unit='call'):
+    return summarize(time_samples(function, repeat, number), number, unit)
+
+
+def create_game(size, dense=False, seed=0):
+    """
+    :param dense: fill the board with bombs on staggered fuses
+    """
+    width, height = SIZES[size]
+    game = Game(width=width, height=height)
+    game.start(['first', 'second'])
+
+    if dense:
+        generator = random.Random(seed)
+        for y in range(1, height - 1, 3):
+            for x in range(1, width - 1, 3):
+                if not game.board.get_tile_objects((x, y)):
+                    bomb = Bomb((x, y), game.board)
+                    bomb.explodes_at = generator.randint(1, Bomb.FUSE)
+                    game._add_object(bomb)
+    return game
+
+
+def bench_game_update(size, dense=False, repeat=300):
+    game = create_game(size, dense)
+
+    def update():
+        # the timers fire by frame number, so every call is a new frame
+        game.frame_number += 1
+        game.board.frame_number = game.frame_number
+        game.update()
+
+    return measure(update, repeat, unit='tick')
+
+
+def bench_game_step(size, dense=False, repeat=300):
+    game = create_game(size, dense)
+    generator = random.Random(0)
+
+    def step():
+        for nickname in list(game.players):
+            game.on_player_key_press(nickname, generator.choice(['up', 'down', 'left', 'right']))
+        game.step()
+
+    return measure(step, repeat, unit='tick')
+
+
+def bench_board_add_object(size, repeat=200, number=100):
+    width, height = SIZES[size]
+    board = Board(StringRenderer(width, height), width, height)
+    players = [Player((x, y), board) for y in range(1, height - 1) for x in range(1, width - 1)]
+    players = players[:number]
+
+    def add_and_remove():
+        for player in players:
+            board.add_object(player)
+        for player in players:
+            board.remove_object(player)
+
+    # every sample adds and removes each of the players once
+    return summarize(time_samples(add_and_remove, repeat), 2 * len(players))
+
+
+def bench_render(size, dirty_rows, repeat=300):
+    """
+    :param dirty_rows: rows re-rendered by every call, None for the whole board
+    """
+    game = create_game(size, dense=True)
+    board = game.board
+
+    def render():
+        if dirty_rows is None:
+            board.renderer.render(board.tiles)
+        else:
+            board.dirty_rows.update(range(dirty_rows))
+            board.render()
+
+    return measure(render, repeat, unit='frame')
+
+
+def bench_create_flames(size, repeat=200, number=50):
+    width, height = SIZES[size]
+    board = Board(StringRenderer(width, height), width, height)
+    bomb = Bomb((width // 2, height // 2), board)
+    return measure(bomb.create_flames, repeat, number)
+
+
+def bench_remove_dead_players(size, dense=False, repeat=300, number=10):
+    game = create_game(size, dense)
+    game.advance(120)
+    game.is_running = True
+
+    # keep the players off the flames, so that every call checks them all
+    width, height = SIZES[size]
+    safe_positions = [(x, y) for y in range(1, height - 1) for x in range(1, width - 1)
+                      if not game.board.get_tile_objects((x, y))]
+    game.players = {nickname: Player(safe_positions[i], game.board)
+                    for i, nickname in enumerate(['first', 'second'])}
+    alive_players = dict(game.players)
+
+    def remove_dead_players():
+        game.players = dict(alive_players)
+        game.remove_dead_players()
+
+    return measure(remove_dead_players, repeat, number)
+
+
+def bench_server(clients=8, duration=5.0, warmup=1.0):
+    """
+    Runs a BombermanServer in a thread and plays idle games with loopback
+    clients, `clients` // 2 rooms of two.
+    """
+    from PodSixNet.EndPoint import EndPoint
+    from room import Room
+    from server import BombermanServer, ClientChannel
+    from frames import FRAME_FORMATS, FrameDecoder
+
+    class CountingChannel(ClientChannel):
+        def __init__(self, *args, **kwargs):
+            ClientChannel.__init__(self, *args, **kwargs)
+            self.frames_sent = 0
+            self.bytes_sent = 0
+
+    class CountingServer(BombermanServer):
+        def SendMessageToPlayers(self, players, action, data):
+            sent = BombermanServer.SendMessageToPlayers(self, players, action, data)
+            if action == 'display_board':
+                for player in players:
+                    player.frames_sent += 1
+                    player.bytes_sent += sent // len(players)
+            return sent
+
+    delays = Room.PRELUDE_DELAY, Room.START_DELAY
+    Room.PRELUDE_DELAY = Room.START_DELAY = 0
+
+    server = CountingServer(localaddr=('127.0.0.1', 0))
+    server.channelClass = CountingChannel
+    server.scheduler.start()
+    address = server.socket.getsockname()
+    serving = True
+
+    def serve():
+        while serving:
+            server.Pump()
+            time.sleep(0.0005)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    endpoints = []
+    for i in range(clients):
+        endpoint = EndPoint(address, map={})
+        endpoint.DoConnect()
+        endpoint.Send({'action': 'hello', 'delta': True, 'formats': list(FRAME_FORMATS)})
+        endpoint.Send({'action': 'nickname', 'nickname': 'client-{}'.format(i)})
+        endpoint.Send({'action': 'join_room', 'room': str(i // 2)})
+        endpoints.append(endpoint)
+
+    decoders = [FrameDecoder() for _ in endpoints]
+    intervals = []
+    last_frames = [None] * len(endpoints)
+    measuring_since = time.perf_counter() + warmup
+    counters = None
+
+    while time.perf_counter() < measuring_since + duration:
+        now = time.perf_counter()
+        if counters is None and now >= measuring_since:
+            counters = [(channel.frames_sent, channel.bytes_sent) for channel in server.channels]
+            ticks = sum(room.ticks for room in list(server.rooms.values()))
+
+        for i, endpoint in enumerate(endpoints):
+            endpoint.Pump()
+            for data in endpoint.GetQueue():
+                if data['action'] != 'display_board':
+                    continue
+                decoders[i].decode(data)
+                if counters is not None and last_frames[i] is not None:
+                    intervals.append(now - last_frames[i])
+                last_frames[i] = now
+        time.sleep(0.0005)
+
+    frames_sent = sum(channel.frames_sent for channel in server.channels) - sum(c[0] for c in counters)
+    bytes_sent = sum(channel.bytes_sent for channel in server.channels) - sum(c[1] for c in counters)
+    ticks = sum(room.ticks for room in list(server.rooms.values())) - ticks
+
+    serving = False
+    thread.join()
+    for endpoint in endpoints:
+        endpoint.close()
+    server.close()
+    Room.PRELUDE_DELAY, Room.START_DELAY = delays
+
+    result = summarize(intervals or [0.0], unit='frame')
+    result.update({
+        'clients': clients,
+        'ticks_per_second': ticks / duration,
+        'frames_sent': frames_sent,
+        'bytes_per_frame': bytes_sent / frames_sent if frames_sent else 0.0,
+    })
+    return result
+
+
+BENCHMARKS = {
+    'game_update[default]': lambda: bench_game_update('default'),
+    'game_update[large]': lambda: bench_game_update('large'),
+    'game_update[dense]': lambda: bench_game_update('default', dense=True),
+    'game_update[large,dense]': lambda: bench_game_update('large', dense=True),
+    'game_step[default]': lambda: bench_game_step('default'),
+    'game_step[dense]': lambda: bench_game_step('default', dense=True),
+    'game_step[large,dense]': lambda: bench_game_step('large', dense=True),
+    'board_add_object[default]': lambda: bench_board_add_object('default'),
+    'board_add_object[large]': lambda: bench_board_add_object('large'),
+    'render[default]': lambda: bench_render('default', None),
+    'render[default,one_row]': lambda: bench_render('default', 1),
+    'render[large]': lambda: bench_render('large', None),
+    'create_flames[default]': lambda: bench_create_flames('default'),
+    'create_flames[large]': lambda: bench_create_flames('large'),
+    'remove_dead_players[default]': lambda: bench_remove_dead_players('default'),
+    'remove_dead_players[dense]': lambda: bench_remove_dead_players('default', dense=True),
+    'server[8_clients]': lambda: bench_server(8),
+}
+
+
+def compare(results, previous):
+    print("{:32} {:>14} {:>14} {:>8} {:>8}".format('benchmark', 'before/s', 'after/s', 'speedup', 'p99'))
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]
+        speedup = result['per_second'] / before['per_second'] if before['per_second'] else float('inf')
+        p99 = before['p99'] / result['p99'] if result['p99'] else float('inf')
+        print("{:32} {:14.1f} {:14.1f} {:7.2f}x {:7.2f}x".format(
+            name, before['per_second'], result['per_second'], speedup, p99))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="compare with the results in this JSON file")
+    parser.add_argument('benchmarks', nargs='*', help="substrings of the benchmarks to run")
+    args = parser.parse_args()
+
+    results = {}
+    for name, benchmark in BENCHMARKS.items():
+        if args.benchmarks and not any(pattern in name for pattern in args.benchmarks):
+            continue
+        results[name] = benchmark()
+        print("{:32} {:14.1f} {}/s  p50 {:.6f}s  p99 {:.6f}s".format(
+            name, results[name]['per_second'], results[name]['unit'],
+            results[name]['p50'], results[name]['p99']))
+        if 'bytes_per_frame' in results[name]:
+            print("{:32} {:14.1f} ticks/s  {:.1f} bytes/frame".format(
+                '', results[name]['ticks_per_second'], results[name]['bytes_per_frame']))
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous)['results'])
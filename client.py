@@ -1,5 +1,7 @@
+import selectors
 from asyncio import sleep
 from sys import stdin, exit
+from time import monotonic
 
 from PodSixNet.Connection import connection, ConnectionListener
 
@@ -7,12 +9,29 @@ from _thread import *
 
 from clientgame import ClientGame
 from consolerenderer import ConsoleRenderer
+from frames import FRAME_FORMATS, FrameDecoder
+from prediction import MovementPredictor
 
 
 class Client(ConnectionListener):
+    # boards arriving faster than this are dropped in favour of the latest
+    # one, None draws every board
+    MAX_RENDER_FPS = 30
+
     def __init__(self, host, port):
         self.in_game = False
+        # watching the room, the keys pressed are ignored
+        self.spectating = False
+        self.board = None
+        self.pending_board = None
+        self.last_render = 0.0
         self.Connect((host, port))
+        connection.Send({"action": "hello", "delta": True, "formats": list(FRAME_FORMATS)})
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(stdin, selectors.EVENT_READ)
+        self.socket_events = selectors.EVENT_READ
+        self.selector.register(connection.socket, self.socket_events)
 
         self.set_nickname()
 
@@ -21,15 +40,56 @@ class Client(ConnectionListener):
 
         self.console = ConsoleRenderer()
         self.client_game = ClientGame(self.console)
+        self.frame_decoder = FrameDecoder()
+        self.predictor = MovementPredictor()
+        self.board = None
         self.in_game = True
 
     def loop(self):
-        key_pressed = self.client_game.getch()
-        if key_pressed:
-            connection.Send({"action": "input", "key": key_pressed})
-
+        """
+        Sleeps until a key is pressed, the server sends something or
+        a board is due to be drawn.
+        """
         connection.Pump()
-        c.Pump()
+        self.Pump()
+        if not self.in_game:
+            return
+        self.render_pending_board()
+
+        # wait for the socket to be writable only while there's something to send
+        socket_events = selectors.EVENT_READ
+        if connection.writable():
+            socket_events |= selectors.EVENT_WRITE
+        if socket_events != self.socket_events:
+            self.selector.modify(connection.socket, socket_events)
+            self.socket_events = socket_events
+
+        self.selector.select(self.get_render_timeout())
+
+        while True:
+            key_pressed = self.client_game.getch()
+            if key_pressed is None:
+                break
+            if key_pressed and not self.spectating:
+                sequence = self.predictor.on_input(key_pressed)
+                connection.Send({"action": "input", "key": key_pressed, "seq": sequence})
+                # show the predicted move without waiting for the server
+                self.pending_board = self.board
+
+    def get_render_timeout(self):
+        if self.pending_board is None:
+            return None
+        if not self.MAX_RENDER_FPS:
+            return 0
+        return max(0.0, self.last_render + 1.0 / self.MAX_RENDER_FPS - monotonic())
+
+    def render_pending_board(self):
+        if self.pending_board is None or self.get_render_timeout():
+            return
+
+        self.console.render(self.predictor.apply(self.pending_board))
+        self.pending_board = None
+        self.last_render = monotonic()
 
     # hackerrank.com
     # udemy.com
@@ -41,18 +101,31 @@ class Client(ConnectionListener):
         nickname = input("Enter your nickname:\n")
         connection.Send({"action": "nickname", "nickname": nickname})
 
-    @staticmethod
-    def set_room():
-        room = input("Enter room number:\n")
-        connection.Send({"action": "join_room", "room": room})
+    def set_room(self):
+        room = input("Enter room number (or 'watch NUMBER' to spectate):\n")
+        self.spectating = room.startswith('watch ')
+        if self.spectating:
+            room = room[len('watch '):]
+        connection.Send({"action": "join_room", "room": room, "watch": self.spectating})
 
     # Network event/message callbacks
 
     def Network_display_board(self, data):
-        board = data['board']
-        self.console.render(board)
+        board = self.frame_decoder.decode(data)
+        if board is None:
+            connection.Send({"action": "request_keyframe"})
+            return
+        self.board = board
+        self.pending_board = board
+
+    def Network_inputack(self, data):
+        self.predictor.on_ack(data['seq'], data['position'])
+        self.pending_board = self.board
 
     def Network_joinedroom(self, data):
+        if data.get('spectating'):
+            self.console.print("Watching room number " + data['room_number'] + '\n')
+            return
         self.console.print("Successfully joined room number " + data['room_number'] + '\n')
         # todo optionally -> you are going to play against
 
@@ -68,9 +141,13 @@ class Client(ConnectionListener):
         self.console.print("The game is going to begin now...\n")
 
     def Network_gameresult(self, data):
+        self.board = self.pending_board = None
         self.console.end()
-        print(
-            "The game has finished. {} won the game.".format(data['winner']))
+        if data['winner'] is None:
+            print("The game has finished. Nobody survived.")
+        else:
+            print(
+                "The game has finished. {} won the game.".format(data['winner']))
 
         sleep(3)
         self.in_game = False
@@ -14,5 +14,11 @@ class ClientGame(object):
         self.console = console
 
     def getch(self):
+        """
+        :return: the name of the pressed key, '' for keys that aren't mapped
+                 or None if no key is waiting
+        """
         key_pressed = self.console.stdscr.getch()
+        if key_pressed == -1:
+            return None
         return self.key_mapping.get(key_pressed, '')
@@ -0,0 +1,77 @@
+import time
+
+
+class GameClock(object):
+    """
+    A fixed-timestep clock based on time.monotonic().
+
+    Ticks are due every 1/fps seconds after the first one. A late tick
+    doesn't move the schedule: the following ticks run back to back until
+    the clock has caught up, unless the clock is more than MAX_CATCH_UP
+    ticks behind - then the missed ticks are dropped.
+    """
+
+    MAX_CATCH_UP = 5
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.tick_time = 1.0 / fps
+        self.next_tick = None
+        self.start_time = None
+        self.ticks = 0
+        self.overruns = 0
+        self.dropped_ticks = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def start(self, now=None):
+        self.start_time = time.monotonic() if now is None else now
+        self.next_tick = self.start_time
+
+    def tick(self, now=None):
+        """
+        Records the beginning of a tick.
+        :param now: time.monotonic() at which the tick began
+        :return: the time at which the next tick is due
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.next_tick is None:
+            self.start(now)
+
+        lateness = max(0.0, now - self.next_tick)
+        self.ticks += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+
+        if lateness >= self.tick_time:
+            self.overruns += 1
+
+        missed_ticks = int(lateness / self.tick_time) - self.MAX_CATCH_UP
+        if missed_ticks > 0:
+            self.dropped_ticks += missed_ticks
+            self.next_tick += missed_ticks * self.tick_time
+
+        self.next_tick += self.tick_time
+        return self.next_tick
+
+    def wait(self):
+        """
+        Sleeps until the next tick is due.
+        """
+        delay = self.next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def stats(self):
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0.0
+        return {
+            'fps': self.fps,
+            'effective_fps': self.ticks / elapsed if elapsed > 0 else 0.0,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'dropped_ticks': self.dropped_ticks,
+            'mean_lateness': self.total_lateness / self.ticks if self.ticks else 0.0,
+            'max_lateness': self.max_lateness,
+        }
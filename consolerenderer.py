@@ -1,5 +1,7 @@
 import curses
 
+from frames import get_changes
+
 
 class ConsoleRenderer(object):
     EMPTY_TILE = ' '
@@ -12,14 +14,32 @@ class ConsoleRenderer(object):
         self.stdscr.keypad(1)
         self.stdscr.scrollok(True)
         self.stdscr.nodelay(True)  # set getch() non-blocking
+        # the board on the screen, None when something else was printed over it
+        self.board = None
         self._clear_screen()
 
     def _clear_screen(self):
-        self.stdscr.clear()
+        # erase() rather than clear(), which would repaint the whole terminal
+        self.stdscr.erase()
+        self.board = None
 
     def render(self, board):
-        self._clear_screen()
-        self.print(board)
+        """
+        Draws only the runs of cells that changed since the previous board
+        and updates the terminal once.
+        """
+        if self.board is None or len(self.board) != len(board):
+            self._clear_screen()
+            self.stdscr.addstr(0, 0, board)
+        else:
+            row_length = board.find('\n') + 1 or len(board)
+            for position, text in get_changes(self.board, board, row_length):
+                y, x = divmod(position, row_length)
+                self.stdscr.addstr(y, x, text)
+
+        self.board = board
+        self.stdscr.noutrefresh()
+        curses.doupdate()
 
     def end(self):
         curses.endwin()
@@ -27,3 +47,5 @@ class ConsoleRenderer(object):
     def print(self, text):
         self._clear_screen()
         self.stdscr.addstr(str(text))
+        self.stdscr.noutrefresh()
+        curses.doupdate()
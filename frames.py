@@ -0,0 +1,270 @@
+"""
+Encoding of the boards sent in display_board messages.
+
+Instead of sending the whole rendered board every frame the server sends
+a keyframe every KEYFRAME_INTERVAL frames (or whenever a client is out of
+sync) and in between only the runs of characters that changed since the
+previous frame.
+
+Boards go out in the first format of the client's hello message that is
+one of FRAME_FORMATS. Every frame is decoded by its own keys, so the
+server doesn't reply with the format it picked:
+ - 'string': the rendered board, newlines included,
+ - 'binary': 4-bit tile codes (see TILE_CODES) packed two per byte,
+   together with the frame number and the board dimensions.
+"""
+from game import StringRenderer
+
+STRING_FORMAT = 'string'
+BINARY_FORMAT = 'binary'
+FRAME_FORMATS = (BINARY_FORMAT, STRING_FORMAT)
+
+TILE_CODES = ''.join([StringRenderer.EMPTY_TILE, StringRenderer.UNKNOWN_TILE]
+                     + sorted(StringRenderer.TILE_MAP.values()))
+
+# Codes below 8 keep every packed byte in the ASCII range, which is what
+# lets the packed tiles travel as a plain string inside a PodSixNet message.
+assert len(TILE_CODES) <= 8
+
+_TILE_TO_CODE = bytearray([TILE_CODES.index(StringRenderer.UNKNOWN_TILE)] * 256)
+for _code, _tile in enumerate(TILE_CODES):
+    _TILE_TO_CODE[ord(_tile)] = _code
+_TILE_TO_CODE = bytes(_TILE_TO_CODE)
+
+_CODE_TO_TILE = bytearray(b'?' * 256)
+for _code, _tile in enumerate(TILE_CODES):
+    _CODE_TO_TILE[_code] = ord(_tile)
+_CODE_TO_TILE = bytes(_CODE_TO_TILE)
+
+
+def board_to_codes(board):
+    """
+    :param board: the rendered board
+    :return: bytes with one tile code per cell, newlines dropped
+    """
+    return board.encode().translate(_TILE_TO_CODE, b'\n')
+
+
+def pack_codes(codes):
+    """
+    Packs two tile codes into every byte, the first one in the high nibble.
+    """
+    if len(codes) % 2:
+        codes = bytes(codes) + b'\0'
+
+    # every code fits in a nibble, so shifting the whole number never
+    # carries a bit over to the neighbouring byte
+    high = int.from_bytes(codes[0::2], 'big')
+    low = int.from_bytes(codes[1::2], 'big')
+    return ((high << 4) | low).to_bytes(len(codes) // 2, 'big')
+
+
+def unpack_codes(packed):
+    size = len(packed)
+    value = int.from_bytes(packed, 'big')
+    mask = int.from_bytes(b'\x0f' * size, 'big')
+
+    codes = bytearray(2 * size)
+    codes[0::2] = ((value >> 4) & mask).to_bytes(size, 'big')
+    codes[1::2] = (value & mask).to_bytes(size, 'big')
+    return codes
+
+
+def _get_row_changes(previous, current, start, end, max_gap):
+    changes = []
+    run_start = None
+    gap = 0
+
+    for i in range(start, end):
+        if previous[i] != current[i]:
+            if run_start is None:
+                run_start = i
+            gap = 0
+        elif run_start is not None:
+            gap += 1
+            if gap > max_gap:
+                changes.append([run_start, current[run_start:i - gap + 1]])
+                run_start = None
+
+    if run_start is not None:
+        changes.append([run_start, current[run_start:end - gap]])
+
+    return changes
+
+
+def get_changes(previous, current, row_length, max_gap=2):
+    """
+    :param previous: the board the client already has
+    :param current: the new board, of the same size as previous
+    :param row_length: length of a single row, including the newline
+    :param max_gap: unchanged characters that may be merged into a run
+    :return: a list of [position, text] runs that turn previous into current
+    """
+    changes = []
+
+    for start in range(0, len(current), row_length):
+        end = start + row_length
+        if previous[start:end] != current[start:end]:
+            changes += _get_row_changes(previous, current, start, end, max_gap)
+
+    return changes
+
+
+class Frame(object):
+    """
+    A single rendered board, encoded lazily in the formats that are needed.
+    """
+
+    def __init__(self, frame_number, board, changes):
+        self.frame_number = frame_number
+        self.board = board
+        self.changes = changes
+        self.row_length = board.find('\n') + 1 or len(board)
+        self.width = self.row_length - 1
+        self.height = len(board) // self.row_length
+        self._codes = None
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            self._codes = board_to_codes(self.board)
+        return self._codes
+
+    def keyframe(self, frame_format):
+        if frame_format == BINARY_FORMAT:
+            return {
+                'frame': self.frame_number,
+                'width': self.width,
+                'height': self.height,
+                'tiles': pack_codes(self.codes).decode('ascii'),
+            }
+        return {'frame': self.frame_number, 'board': self.board}
+
+    def delta(self, frame_format):
+        if frame_format == BINARY_FORMAT:
+            return {
+                'frame': self.frame_number,
+                'cells': [self._pack_run(position, text) for position, text in self.changes],
+            }
+        return {'frame': self.frame_number, 'changes': self.changes}
+
+    def _pack_run(self, position, text):
+        start = position - position // self.row_length
+        end = start + len(text)
+
+        # runs are packed whole bytes at a time, so odd runs take one more cell
+        if (end - start) % 2:
+            if end < len(self.codes):
+                end += 1
+            else:
+                start -= 1
+
+        return [start, pack_codes(self.codes[start:end]).decode('ascii')]
+
+
+class FrameEncoder(object):
+    """
+    Server side: remembers the previous board and the last frame that was
+    sent to every client.
+    """
+
+    KEYFRAME_INTERVAL = 30
+
+    def __init__(self):
+        self.frame_number = 0
+        self.previous_board = None
+        self.last_frames = {}
+
+    def forget(self, client):
+        self.last_frames.pop(client, None)
+
+    def request_keyframe(self, client):
+        self.last_frames.pop(client, None)
+
+    def _get_changes(self, board):
+        if (self.previous_board is None
+                or len(self.previous_board) != len(board)
+                or self.frame_number % self.KEYFRAME_INTERVAL == 0):
+            return None
+
+        row_length = board.find('\n') + 1 or len(board)
+        return get_changes(self.previous_board, board, row_length)
+
+    def encode(self, board, clients):
+        """
+        :param board: the rendered board
+        :param clients: clients that should receive the frame
+        :return: a list of (clients, message) pairs, one per distinct message
+        """
+        self.frame_number += 1
+        frame = Frame(self.frame_number, board, self._get_changes(board))
+
+        groups = {}
+        for client in clients:
+            up_to_date = self.last_frames.get(client) == self.frame_number - 1
+            is_delta = frame.changes is not None and up_to_date and client.delta_frames
+            groups.setdefault((client.frame_format, is_delta), []).append(client)
+            self.last_frames[client] = self.frame_number
+
+        self.previous_board = board
+
+        return [(group, frame.delta(frame_format) if is_delta else frame.keyframe(frame_format))
+                for (frame_format, is_delta), group in groups.items()]
+
+
+class FrameDecoder(object):
+    """
+    Client side: rebuilds the board from keyframes and deltas.
+    """
+
+    def __init__(self):
+        self.frame_number = None
+        self.board = None
+        self.width = None
+
+    def _write_cells(self, cell, codes):
+        tiles = codes.translate(_CODE_TO_TILE)
+        row_length = self.width + 1
+        offset = 0
+
+        while offset < len(tiles):
+            row, column = divmod(cell + offset, self.width)
+            count = min(self.width - column, len(tiles) - offset)
+            position = row * row_length + column
+            self.board[position:position + count] = tiles[offset:offset + count]
+            offset += count
+
+    def _apply_keyframe(self, data):
+        if 'board' in data:
+            self.board = bytearray(data['board'].encode())
+            return
+
+        self.width = data['width']
+        cell_count = self.width * data['height']
+        self.board = bytearray(b'\n' * (cell_count + data['height']))
+        self._write_cells(0, unpack_codes(data['tiles'].encode('ascii'))[:cell_count])
+
+    def _apply_delta(self, data):
+        if 'changes' in data:
+            for position, text in data['changes']:
+                self.board[position:position + len(text)] = text.encode()
+            return
+
+        for cell, tiles in data['cells']:
+            self._write_cells(cell, unpack_codes(tiles.encode('ascii')))
+
+    def decode(self, data):
+        """
+        :param data: a display_board message
+        :return: the rebuilt board or None if a keyframe is needed first
+        """
+        if 'board' in data or 'tiles' in data:
+            self._apply_keyframe(data)
+        elif self.board is not None and data['frame'] == self.frame_number + 1:
+            self._apply_delta(data)
+        else:
+            self.board = None
+            return None
+
+        self.frame_number = data['frame']
+        return self.board.decode()
@@ -1,9 +1,57 @@
-import time
+import threading
+from array import array
+from collections import deque
+
+from clock import GameClock
+from timers import TimingWheel
+
+
+class ObjectPool(object):
+    """
+    A free list of released objects of a single class. acquire() re-runs
+    __init__ on a released object rather than allocating a new one.
+    """
+
+    def __init__(self, object_class, max_size=10000):
+        self.object_class = object_class
+        self.max_size = max_size
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+        self.released = 0
+
+    def acquire(self, *args):
+        try:
+            obj = self.free.pop()
+        except IndexError:
+            self.allocated += 1
+            return self.object_class(*args)
+
+        self.reused += 1
+        obj.__init__(*args)
+        return obj
+
+    def release(self, obj):
+        if len(self.free) < self.max_size:
+            self.released += 1
+            self.free.append(obj)
+
+    @property
+    def stats(self):
+        return {
+            'allocated': self.allocated,
+            'reused': self.reused,
+            'released': self.released,
+            'free': len(self.free),
+        }
 
 
 class BoardObject(object):
+    __slots__ = ('position',)
 
     OBJECT_NAME = 'object'
+    OBJECT_BIT = 0x40
+    pool = None
 
     def __init__(self, position):
         self.position = position
@@ -16,56 +64,69 @@ class BoardObject(object):
 
 
 class Flame(BoardObject):
+    """
+    Flames aren't kept as objects: the Board stores, for every tile, the
+    frame at which the flame on it burns out.
+    """
+    __slots__ = ()
 
     OBJECT_NAME = 'flame'
-
-    def __init__(self, position):
-        super().__init__(position)
-        self.frames_until_removal = 50
-
-    def update(self):
-        self.frames_until_removal -= 1
-        if self.frames_until_removal <= 0:
-            self.remove()
+    OBJECT_BIT = 0x08
+    DURATION = 50
 
 
 class Bomb(BoardObject):
+    __slots__ = ('explodes_at', 'board')
 
     OBJECT_NAME = 'bomb'
+    OBJECT_BIT = 0x04
     EXPLOSION_RANGE = (5, 5, 10, 10)
+    FUSE = 90
 
     def __init__(self, position, board):
         super().__init__(position)
-        self.frames_until_removal = 90
+        self.explodes_at = board.frame_number + self.FUSE
         self.board = board
 
     def create_flames(self):
+        """
+        :return: the vertical and the horizontal (start, stop, step) slices of
+                 the board's tiles covered by the explosion
+        """
         bomb_x, bomb_y = self.position
         up, down, left, right = self.EXPLOSION_RANGE
+        row_length = self.board.row_length
 
-        up_flames = [Flame((bomb_x, bomb_y - y)) for y in range(up) if bomb_y - y > 0]
-        right_flames = [Flame((bomb_x + x, bomb_y)) for x in range(right) if bomb_x + x < self.board.width-1]
-        down_flames = [Flame((bomb_x, bomb_y + y)) for y in range(down) if bomb_y + y < self.board.height-1]
-        left_flames = [Flame((bomb_x - x, bomb_y)) for x in range(left) if bomb_x - x > 0]
+        top = max(1, bomb_y - up + 1)
+        bottom = min(self.board.height - 2, bomb_y + down - 1)
+        leftmost = max(1, bomb_x - left + 1)
+        rightmost = min(self.board.width - 2, bomb_x + right - 1)
 
-        return up_flames + right_flames + down_flames + left_flames
+        flames = []
+        if top <= bottom:
+            flames.append((top * row_length + bomb_x, bottom * row_length + bomb_x + 1, row_length))
+        if leftmost <= rightmost:
+            flames.append((bomb_y * row_length + leftmost, bomb_y * row_length + rightmost + 1, 1))
+        return flames
 
-    def update(self):
-        self.frames_until_removal -= 1
-        if self.frames_until_removal <= 0:
-            flames = self.create_flames()
-            self.remove()
-            return flames
+    def explode(self):
+        self.board.add_flames(self.create_flames())
+        self.board.remove_object(self)
+        self.remove()
 
 
 class Block(BoardObject):
+    __slots__ = ()
 
     OBJECT_NAME = 'block'
+    OBJECT_BIT = 0x01
 
 
 class Player(BoardObject):
+    __slots__ = ('x_speed', 'y_speed', 'board', 'planting_bomb')
 
     OBJECT_NAME = 'player'
+    OBJECT_BIT = 0x02
 
     def __init__(self, position, board):
         super().__init__(position)
@@ -79,14 +140,14 @@ class Player(BoardObject):
         new_x, new_y = player_x + x, player_y + y
         new_position = (new_x, new_y)
 
-        tile_objects = self.board.get_tile_objects(new_position)
-
-        if (Block.OBJECT_NAME in tile_objects
-            or new_x < 0 or new_x > self.board.width-1
-                or new_y < 0 or new_y > self.board.height-1):
+        if (new_x < 0 or new_x > self.board.width-1
+                or new_y < 0 or new_y > self.board.height-1
+                or self.board.has_object(new_position, Block)):
             return
 
+        old_position = self.position
         self.position = new_position
+        self.board.move_object(self, old_position)
 
     def move_right(self):
         self._move(self.x_speed, 0)
@@ -106,40 +167,136 @@ class Player(BoardObject):
     def update(self):
         if self.planting_bomb:
             self.planting_bomb = False
-            return [Bomb(self.position, self.board)]
+            return [Bomb.pool.acquire(self.position, self.board)]
+
+
+Bomb.pool = ObjectPool(Bomb)
 
 
 class Board(object):
+    """
+    Every tile is a single byte holding the OBJECT_BITs of the objects
+    placed on it. Rows are followed by an END_OF_ROW byte, so that the
+    renderer can translate the whole board in one go.
+
+    Objects that never move nor disappear (blocks) are kept in a static
+    layer; the remaining ones are counted per tile, so that they can be
+    added, moved and removed one at a time. Rows whose tiles changed since
+    the last render are collected in dirty_rows.
+
+    Flames live in flame_expiry, which holds the frame at which the flame
+    on each tile burns out: explosions are slice assignments and a tile is
+    on fire while its expiry is ahead of frame_number.
+
+    Bomb fuses and flame removals are scheduled in the `timers` wheel.
+    """
+
+    END_OF_ROW = 0x80
+
+    # in the order in which they cover each other when rendered
+    OBJECT_CLASSES = (Block, Player, Bomb, Flame, BoardObject)
 
     def __init__(self, renderer, width, height):
         self.renderer = renderer
         self.width = width
         self.height = height
+        self.row_length = width + 1
+        self.static_tiles = Board.initialize_tiles(width, height)
         self.tiles = Board.initialize_tiles(width, height)
+        self.counts = {object_class.OBJECT_BIT: array('H', bytes(2 * len(self.tiles)))
+                       for object_class in self.OBJECT_CLASSES}
+        self.dirty_rows = set(range(height))
+        self.frame_number = 0
+        self.flame_expiry = array('q', bytes(8 * len(self.tiles)))
+        self.timers = TimingWheel()
 
     @classmethod
     def initialize_tiles(cls, width, height):
-        tiles = [[] for _ in range(height)]
-
-        for line in tiles:
-            for _ in range(width):
-                line.append([])
-
+        tiles = bytearray((width + 1) * height)
+        tiles[width::width + 1] = bytes([cls.END_OF_ROW]) * height
         return tiles
 
-    def clear(self):
-        self.tiles = Board.initialize_tiles(self.width, self.height)
+    def _set_tile(self, index, tile):
+        if self.tiles[index] != tile:
+            self.tiles[index] = tile
+            self.dirty_rows.add(index // self.row_length)
 
-    def add_object(self, board_object):
+    def add_static_object(self, board_object):
         x, y = board_object.position
-        self.tiles[y][x].append(board_object.OBJECT_NAME)
+        index = y * self.row_length + x
+        self.static_tiles[index] |= board_object.OBJECT_BIT
+        self._set_tile(index, self.tiles[index] | board_object.OBJECT_BIT)
+
+    def add_object(self, board_object, position=None):
+        x, y = position or board_object.position
+        index = y * self.row_length + x
+        self.counts[board_object.OBJECT_BIT][index] += 1
+        self._set_tile(index, self.tiles[index] | board_object.OBJECT_BIT)
+
+    def remove_object(self, board_object, position=None):
+        x, y = position or board_object.position
+        index = y * self.row_length + x
+        counts = self.counts[board_object.OBJECT_BIT]
+        counts[index] -= 1
+        if not counts[index] and not self.static_tiles[index] & board_object.OBJECT_BIT:
+            self._set_tile(index, self.tiles[index] & ~board_object.OBJECT_BIT)
+
+    def move_object(self, board_object, old_position):
+        self.remove_object(board_object, old_position)
+        self.add_object(board_object)
+
+    def _mark_dirty(self, start, stop):
+        self.dirty_rows.update(range(start // self.row_length, (stop - 1) // self.row_length + 1))
+
+    def add_flames(self, flames):
+        """
+        :param flames: (start, stop, step) slices of the tiles set on fire
+        """
+        expires_at = self.frame_number + Flame.DURATION
+
+        for start, stop, step in flames:
+            tiles = slice(start, stop, step)
+            self.flame_expiry[tiles] = array('q', [expires_at]) * len(range(start, stop, step))
+            self.tiles[tiles] = self.tiles[tiles].translate(_ADD_FLAME)
+            self._mark_dirty(start, stop)
+
+        self.timers.schedule(expires_at, self.remove_flames, flames)
+
+    def remove_flames(self, flames):
+        for start, stop, step in flames:
+            tiles = slice(start, stop, step)
+            if max(self.flame_expiry[tiles]) <= self.frame_number:
+                self.tiles[tiles] = self.tiles[tiles].translate(_REMOVE_FLAME)
+                self._mark_dirty(start, stop)
+                continue
+
+            # partially covered by a later explosion
+            for index in range(start, stop, step):
+                if self.flame_expiry[index] <= self.frame_number:
+                    self._set_tile(index, self.tiles[index] & ~Flame.OBJECT_BIT)
+
+    def is_on_fire(self, position):
+        x, y = position
+        return self.flame_expiry[y * self.row_length + x] > self.frame_number
+
+    def has_object(self, position, object_class):
+        x, y = position
+        return bool(self.tiles[y * self.row_length + x] & object_class.OBJECT_BIT)
 
     def get_tile_objects(self, position):
         x, y = position
-        return self.tiles[y][x]
+        tile = self.tiles[y * self.row_length + x]
+        return [object_class.OBJECT_NAME for object_class in self.OBJECT_CLASSES
+                if tile & object_class.OBJECT_BIT]
 
     def render(self):
-        return self.renderer.render(self.tiles)
+        rendered = self.renderer.render(self.tiles, self.dirty_rows)
+        self.dirty_rows.clear()
+        return rendered
+
+
+_ADD_FLAME = bytes(tile | Flame.OBJECT_BIT for tile in range(256))
+_REMOVE_FLAME = bytes(tile & ~Flame.OBJECT_BIT for tile in range(256))
 
 
 class StringRenderer(object):
@@ -156,24 +313,106 @@ class StringRenderer(object):
     def __init__(self, width, height):
         self.width = width
         self.height = height
+        self.row_length = width + 1
+        self.translation = self._get_translation()
+        self.output = bytearray(self.row_length * height)
+        self.rendered = None
 
-    def _get_buffered_output(self, tiles):
-        output = []
+    @classmethod
+    def _get_tile(cls, tile):
+        if tile == Board.END_OF_ROW:
+            return "\n"
 
-        for y in range(self.height):
-            for x in range(self.width):
-                tile = tiles[y][x]
+        for object_class in Board.OBJECT_CLASSES:
+            if tile & object_class.OBJECT_BIT:
+                return cls.TILE_MAP.get(object_class.OBJECT_NAME, cls.UNKNOWN_TILE)
 
-                if tile:
-                    output.append(self.TILE_MAP.get(tile[0], self.UNKNOWN_TILE))
-                else:
-                    output.append(self.EMPTY_TILE)
-            output.append("\n")
+        return cls.EMPTY_TILE
 
-        return "".join(output)
+    @classmethod
+    def _get_translation(cls):
+        return "".join(cls._get_tile(tile) for tile in range(256)).encode()
+
+    def render(self, tiles, dirty_rows=None):
+        """
+        :param tiles: the tiles of a Board
+        :param dirty_rows: rows changed since the previous call, None if unknown
+        :return: the rendered board, the cached one if nothing has changed
+        """
+        if self.rendered is not None and dirty_rows is not None:
+            if not dirty_rows:
+                return self.rendered
+
+            if len(dirty_rows) < self.height // 2:
+                for row in dirty_rows:
+                    start = row * self.row_length
+                    end = start + self.row_length
+                    self.output[start:end] = tiles[start:end].translate(self.translation)
+                self.rendered = self.output.decode()
+                return self.rendered
+
+        self.output[:] = tiles.translate(self.translation)
+        self.rendered = self.output.decode()
+        return self.rendered
+
+
+class InputQueue(object):
+    """
+    Actions of the players waiting for the next tick.
+
+    Network threads push() while the game takes() the actions of a tick
+    under a lock, so no action is lost in between. Every player's actions
+    wait in the order they came in and a tick handles at most one action
+    per slot: a client that sends its keys faster than the game runs has
+    them applied on the following ticks rather than dropped. A player has
+    at most MAX_QUEUED actions waiting, beyond that the oldest is dropped.
+
+    The sequence number of the last action handled for every player is
+    kept alongside, for the clients that predict their own moves; the
+    actions before it have all been handled too.
+    """
+
+    MAX_QUEUED = 8
 
-    def render(self, tiles):
-        return self._get_buffered_output(tiles)
+    def __init__(self):
+        self._lock = threading.Lock()
+        # nickname -> deque of (slot, action, sequence)
+        self._pending = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def push(self, nickname, slot, action, sequence=None):
+        with self._lock:
+            actions = self._pending.get(nickname)
+            if actions is None:
+                actions = self._pending[nickname] = deque()
+            elif len(actions) >= self.MAX_QUEUED:
+                actions.popleft()
+                self.coalesced += 1
+            actions.append((slot, action, sequence))
+
+    def take(self):
+        """
+        :return: a dict of the {slot: action} dicts to handle this tick by
+                 nickname and a dict of the sequence numbers of the last
+                 actions among them by nickname
+        """
+        taken = {}
+        sequences = {}
+        with self._lock:
+            for nickname, actions in list(self._pending.items()):
+                slots = taken[nickname] = {}
+                # in order, up to the first action whose slot is already used
+                while actions and actions[0][0] not in slots:
+                    slot, action, sequence = actions.popleft()
+                    slots[slot] = action
+                    if sequence is not None:
+                        sequences[nickname] = sequence
+                if not actions:
+                    del self._pending[nickname]
+        return taken, sequences
 
 
 class Game(object):
@@ -182,92 +421,166 @@ class Game(object):
     WIDTH = 64
     HEIGHT = 32
 
+    # key -> (input slot, action), a player gets one action per slot every tick
     KEY_ACTION_MAPPING = {
-        'up': Player.move_up,
-        'down': Player.move_down,
-        'left': Player.move_left,
-        'right': Player.move_right,
-        'x': Player.plant_bomb,
+        'up': ('move', Player.move_up),
+        'down': ('move', Player.move_down),
+        'left': ('move', Player.move_left),
+        'right': ('move', Player.move_right),
+        'x': ('bomb', Player.plant_bomb),
     }
 
-    def __init__(self):
-        self.renderer = StringRenderer(self.WIDTH, self.HEIGHT)
-        self.board = Board(self.renderer, self.WIDTH, self.HEIGHT)
+    def __init__(self, fps=None, width=None, height=None):
+        self.width = width or self.WIDTH
+        self.height = height or self.HEIGHT
+        self.clock = GameClock(fps or self.FPS)
+        self.renderer = StringRenderer(self.width, self.height)
+        self.board = Board(self.renderer, self.width, self.height)
         self.players = {}
-        self.objects = []
-        self.key_presses = []
+        self.blocks = []
+        self.bombs = []
+        self.input_queue = InputQueue()
+        # the sequence number of the last input handled for every player
+        self.input_sequences = {}
         self.is_running = False
-        self.last_frame_time = 0
+        self.frame_number = 0
         self.rendered_board = ''
+        # a metrics.PhaseTimer, when the phases of step() should be timed
+        self.phase_timer = None
+        # a replay.GameRecorder, when the handled inputs should be recorded
+        self.recorder = None
+
+    def _add_object(self, obj):
+        if isinstance(obj, Bomb):
+            self.bombs.append(obj)
+            self.board.timers.schedule(obj.explodes_at, self._explode, obj)
+        self.board.add_object(obj)
+
+    def _explode(self, bomb):
+        bomb.explode()
+        self.bombs.remove(bomb)
+        Bomb.pool.release(bomb)
 
     def update(self):
-        self.board.clear()
-
-        new_objects = []
-        for obj in self.objects:
-            objects = obj.update()
-            if objects:
-                new_objects += objects
+        """
+        Fires the bombs and flame removals due on this frame and lets the
+        players plant their bombs - nothing else needs to be touched.
+        """
+        for function, argument in self.board.timers.advance(self.frame_number):
+            function(argument)
 
-        self.objects += new_objects
-        self.objects = [obj for obj in self.objects if obj.position]
-
-        for obj in self.objects:
-            self.board.add_object(obj)
+        for player in self.players.values():
+            for obj in player.update() or ():
+                self._add_object(obj)
 
     def remove_dead_players(self):
         removed_players = []
 
         for nickname, player in self.players.items():
-            tiles = self.board.get_tile_objects(player.position)
-            if Flame.OBJECT_NAME in tiles:
+            if self.board.is_on_fire(player.position):
+                self.board.remove_object(player)
                 player.remove()
                 removed_players.append(nickname)
 
         for nickname in removed_players:
             del self.players[nickname]
 
-        if len(self.players) == 1:
+        if len(self.players) <= 1:
             self.is_running = False
 
-    def process_loop_once(self):
-        if not self.is_running:
-            return
-
-        current_time = time.time()
-
+    @property
+    def winner(self):
+        """
+        :return: nickname of the last player standing, None if nobody survived
+        """
+        if len(self.players) == 1:
+            return next(iter(self.players))
+        return None
+
+    def step(self, render=True):
+        """
+        Advances the game by a single frame without waiting for the next one.
+        """
+        timer = self.phase_timer
+        if timer:
+            timer.start()
+
+        self.frame_number += 1
+        self.board.frame_number = self.frame_number
         self.handle_key_presses()
+        if timer:
+            timer.lap('input')
         self.update()
+        if timer:
+            timer.lap('update')
         self.remove_dead_players()
-        self.rendered_board = self.board.render()
+        if timer:
+            timer.lap('remove_dead_players')
+        if render:
+            self.rendered_board = self.board.render()
+            if timer:
+                timer.lap('render')
+
+    def advance(self, frames, get_key_presses=None, render=False):
+        """
+        Runs up to `frames` frames as fast as possible, ignoring the clock.
+        :param get_key_presses: called as get_key_presses(game) before every
+                                frame, returns (nickname, key_name) pairs
+        :param render: whether to render the board after every frame
+        :return: the number of frames that were run before the game ended
+        """
+        for frame in range(frames):
+            if not self.is_running:
+                return frame
+
+            if get_key_presses:
+                for nickname, key_name in get_key_presses(self):
+                    self.on_player_key_press(nickname, key_name)
+            self.step(render)
+
+        return frames
 
-        sleep_time = 1.0/self.FPS - (current_time - self.last_frame_time)
-        self.last_frame_time = current_time
-        if sleep_time > 0:
-            time.sleep(sleep_time)
+    def process_loop_once(self):
+        if not self.is_running:
+            return
 
-    def on_player_key_press(self, nickname, key_name):
-        self.key_presses.append((nickname, key_name))
+        self.clock.tick()
+        self.step()
+        self.clock.wait()
+
+    def on_player_key_press(self, nickname, key_name, sequence=None):
+        """
+        Queues the action of the key for the next tick, may be called from
+        any thread. Unknown keys are ignored.
+        :param sequence: the client's sequence number of the input
+        """
+        if key_name in self.KEY_ACTION_MAPPING:
+            slot, _ = self.KEY_ACTION_MAPPING[key_name]
+            self.input_queue.push(nickname, slot, key_name, sequence)
 
     def handle_key_presses(self):
-        for nickname, key_name in self.key_presses:
+        actions_by_player, sequences = self.input_queue.take()
+        self.input_sequences.update(sequences)
+
+        for nickname, actions in actions_by_player.items():
             player = self.players.get(nickname)
 
             if not player:
                 continue
 
-            action = self.KEY_ACTION_MAPPING[key_name]
-            action(player)
-
-        self.key_presses = []
+            for key_name in actions.values():
+                _, action = self.KEY_ACTION_MAPPING[key_name]
+                action(player)
+                if self.recorder:
+                    self.recorder.record(self.frame_number, nickname, key_name)
 
     def _initialize_blocks(self):
-        blocks = [Block((x, 0)) for x in range(self.WIDTH)]
-        blocks += [Block((0, y)) for y in range(self.HEIGHT)]
-        blocks += [Block((x, self.HEIGHT-1)) for x in range(self.WIDTH)]
-        blocks += [Block((self.WIDTH-1, y)) for y in range(self.HEIGHT)]
-        blocks += [Block((x, y)) for y in range(2, self.HEIGHT-3, 4)
-                   for x in range(2, self.WIDTH-3, 2)]
+        blocks = [Block((x, 0)) for x in range(self.width)]
+        blocks += [Block((0, y)) for y in range(self.height)]
+        blocks += [Block((x, self.height-1)) for x in range(self.width)]
+        blocks += [Block((self.width-1, y)) for y in range(self.height)]
+        blocks += [Block((x, y)) for y in range(2, self.height-3, 4)
+                   for x in range(2, self.width-3, 2)]
         return blocks
 
     def _initialize_players(self, nicknames):
@@ -276,8 +589,11 @@ class Game(object):
 
     def start(self, nicknames):
         self.players = self._initialize_players(nicknames)
-        blocks = self._initialize_blocks()
+        self.blocks = self._initialize_blocks()
 
-        self.objects = blocks + list(self.players.values())
-        self.is_running = True
+        for block in self.blocks:
+            self.board.add_static_object(block)
+        for player in self.players.values():
+            self.board.add_object(player)
 
+        self.is_running = True
@@ -0,0 +1,130 @@
+"""
+Plays games without a server, a clock or a screen, as fast as the CPU
+allows - for balance testing and for training bots.
+
+    python3 headless.py --games 1000 --processes 8
+"""
+import argparse
+import multiprocessing
+import random
+import time
+
+from game import Game
+
+
+class RandomBot(object):
+    """
+    Presses a random key on some of the frames.
+    """
+
+    KEYS = ('up', 'down', 'left', 'right', 'x')
+
+    def __init__(self, nickname, seed=None, key_probability=0.3, bomb_probability=0.05):
+        self.nickname = nickname
+        self.random = random.Random(seed)
+        self.key_probability = key_probability
+        self.bomb_probability = bomb_probability
+
+    def get_key(self, game):
+        """
+        :return: the key pressed on this frame or None
+        """
+        if self.random.random() >= self.key_probability:
+            return None
+        if self.random.random() < self.bomb_probability:
+            return 'x'
+        return self.random.choice(self.KEYS[:4])
+
+
+class ScriptedBot(object):
+    """
+    Presses the keys of a {frame_number: key} script.
+    """
+
+    def __init__(self, nickname, script):
+        self.nickname = nickname
+        self.script = script
+
+    def get_key(self, game):
+        return self.script.get(game.frame_number + 1)
+
+
+def get_bots_key_presses(bots):
+    def get_key_presses(game):
+        key_presses = []
+        for bot in bots:
+            key = bot.get_key(game)
+            if key:
+                key_presses.append((bot.nickname, key))
+        return key_presses
+
+    return get_key_presses
+
+
+def play_game(bots, max_frames=10000, render=False):
+    """
+    :param bots: objects with a nickname and a get_key(game) method
+    :return: a dict describing the outcome of the game
+    """
+    game = Game()
+    game.start([bot.nickname for bot in bots])
+
+    start_time = time.perf_counter()
+    frames = game.advance(max_frames, get_bots_key_presses(bots), render)
+    duration = time.perf_counter() - start_time
+
+    return {
+        'winner': game.winner,
+        'finished': not game.is_running,
+        'frames': frames,
+        'duration': duration,
+    }
+
+
+def play_random_game(seed, max_frames=10000):
+    bots = [RandomBot('bot-{}'.format(i), seed='{}-{}'.format(seed, i)) for i in range(2)]
+    result = play_game(bots, max_frames)
+    result['seed'] = seed
+    return result
+
+
+def _play_random_game(args):
+    return play_random_game(*args)
+
+
+def run_batch(games, processes=None, max_frames=10000, first_seed=0):
+    """
+    Plays `games` games between random bots on a process pool.
+    :return: results of the games and a summary of the batch
+    """
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_play_random_game,
+                           [(seed, max_frames) for seed in range(first_seed, first_seed + games)],
+                           chunksize=max(1, games // (4 * (processes or multiprocessing.cpu_count()))))
+    duration = time.perf_counter() - start_time
+
+    frames = sum(result['frames'] for result in results)
+    summary = {
+        'games': games,
+        'finished_games': sum(result['finished'] for result in results),
+        'draws': sum(result['finished'] and result['winner'] is None for result in results),
+        'frames': frames,
+        'duration': duration,
+        'ticks_per_second': frames / duration if duration else 0.0,
+        'games_per_second': games / duration if duration else 0.0,
+    }
+    return results, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--max-frames', type=int, default=10000)
+    parser.add_argument('--first-seed', type=int, default=0)
+    args = parser.parse_args()
+
+    _, summary = run_batch(args.games, args.processes, args.max_frames, args.first_seed)
+    for key, value in summary.items():
+        print("{}: {}".format(key, value))
@@ -0,0 +1,275 @@
+"""
+Load test of a running server with headless bot clients.
+
+    python3 server.py &
+    python3 loadtest.py --clients 1000 --duration 60 --key-rate 5
+
+Every bot is a PodSixNet connection that says hello, sets its nickname and
+joins a room together with the next bot, then plays by pressing random (or
+--script) keys at --key-rate keys a second, and joins again whenever its
+game ends. Another --spectators bots watch the first room. The report
+covers the join latency, the rate at which frames arrive, the jitter of
+the intervals between them and the bytes received.
+
+All the bots share one poll() loop, so thousands of them fit in a single
+process - as long as the open files limit allows, see `ulimit -n`.
+"""
+import argparse
+import itertools
+import json
+import random
+import resource
+import statistics
+import time
+
+from PodSixNet.Channel import Channel
+from PodSixNet.EndPoint import EndPoint
+from PodSixNet.asyncwrapper import asyncore
+
+from benchmark import summarize
+from frames import FRAME_FORMATS, FrameDecoder
+
+MOVE_KEYS = ('up', 'down', 'left', 'right')
+
+
+class LoadBot(EndPoint):
+    """
+    A headless client; its Network_* handlers only keep statistics.
+    """
+
+    def __init__(self, number, address, room, map, key_rate=5.0, bomb_probability=0.0,
+                 script=None, seed=None, watch=False):
+        """
+        :param script: keys to press in turn instead of random ones
+        :param watch: join the room as a spectator
+        """
+        EndPoint.__init__(self, address, map)
+        self.nickname = 'load-{}'.format(number)
+        self.room = room
+        self.watch = watch
+        self.key_interval = 1.0 / key_rate if key_rate else None
+        self.bomb_probability = bomb_probability
+        self.script = itertools.cycle(script) if script else None
+        self.random = random.Random(seed)
+        self.decoder = FrameDecoder()
+
+        self.playing = False
+        self.started_at = None
+        self.stopped_at = None
+        self.join_time = None
+        self.next_key_time = None
+        self.last_frame_time = None
+        self.input_sequence = 0
+
+        self.join_latencies = []
+        self.frame_intervals = []
+        self.frames = 0
+        self.games = 0
+        self.declined = 0
+        self.keys_sent = 0
+        self.bytes_received = 0
+        self.disconnected = False
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.DoConnect()
+        self.Send({'action': 'hello', 'delta': True, 'formats': list(FRAME_FORMATS)})
+        self.Send({'action': 'nickname', 'nickname': self.nickname})
+        self.join()
+
+    def join(self):
+        self.join_time = time.perf_counter()
+        self.Send({'action': 'join_room', 'room': self.room, 'watch': self.watch})
+
+    def collect_incoming_data(self, data):
+        self.bytes_received += len(data)
+        EndPoint.collect_incoming_data(self, data)
+
+    def get_key(self):
+        if self.script:
+            return next(self.script)
+        if self.random.random() < self.bomb_probability:
+            return 'x'
+        return self.random.choice(MOVE_KEYS)
+
+    def press_keys(self, now):
+        if not self.playing or self.watch or self.key_interval is None:
+            return
+
+        if self.next_key_time is None:
+            self.next_key_time = now + self.random.random() * self.key_interval
+        while self.next_key_time <= now:
+            self.input_sequence += 1
+            self.Send({'action': 'input', 'key': self.get_key(), 'seq': self.input_sequence})
+            self.keys_sent += 1
+            self.next_key_time += self.key_interval
+
+    # Network event/message callbacks
+
+    def Network(self, data):
+        # the statistics are all that's kept, not the messages
+        pass
+
+    def Network_joinedroom(self, data):
+        self.join_latencies.append(time.perf_counter() - self.join_time)
+
+    def Network_declinedroom(self, data):
+        self.declined += 1
+
+    def Network_gamestart(self, data):
+        self.playing = True
+        self.next_key_time = None
+
+    def Network_display_board(self, data):
+        now = time.perf_counter()
+        if self.last_frame_time is not None:
+            self.frame_intervals.append(now - self.last_frame_time)
+        self.last_frame_time = now
+        self.frames += 1
+
+        if self.decoder.decode(data) is None:
+            self.Send({'action': 'request_keyframe'})
+
+    def Network_gameresult(self, data):
+        self.playing = False
+        self.games += 1
+        self.last_frame_time = None
+        self.decoder = FrameDecoder()
+        self.join()
+
+    def Close(self):
+        self.disconnected = True
+        self.playing = False
+        EndPoint.Close(self)
+
+
+def raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def run_load_test(address, clients, duration, key_rate=5.0, bomb_probability=0.0, script=None,
+                  ramp_up=5.0, first_room=0, seed=0, spectators=0):
+    """
+    :param ramp_up: seconds over which the bots connect
+    :param spectators: bots that watch the first room, on top of `clients`
+    :return: the bots, once `duration` seconds have passed since the last one connected
+    """
+    connections = {}
+    bots = [LoadBot(number, address, str(first_room + number // 2), connections, key_rate,
+                    bomb_probability, script, '{}-{}'.format(seed, number))
+            for number in range(clients)]
+    bots += [LoadBot(number, address, str(first_room), connections, watch=True)
+             for number in range(clients, clients + spectators)]
+    clients = len(bots)
+
+    start_time = time.perf_counter()
+    end_time = start_time + ramp_up + duration
+    started = 0
+
+    while True:
+        now = time.perf_counter()
+        if now >= end_time:
+            break
+
+        # connect the bots at an even rate, in pairs so that rooms fill up
+        due = clients if not ramp_up else min(clients, int((now - start_time) / ramp_up * clients) + 2)
+        while started < due:
+            bots[started].start()
+            started += 1
+
+        for bot in bots[:started]:
+            bot.press_keys(now)
+            if bot.sendqueue:
+                # EndPoint.Pump() would poll the shared map once per bot
+                Channel.Pump(bot)
+        asyncore.poll2(0.001, connections)
+
+    for bot in bots:
+        bot.stopped_at = now
+        bot.close()
+    return bots
+
+
+def summarize_bots(bots):
+    players = [bot for bot in bots if not bot.watch]
+    spectators = [bot for bot in bots if bot.watch]
+
+    summary = _summarize_bots(players)
+    if spectators:
+        summary['spectators'] = _summarize_bots(spectators)
+    return summary
+
+
+def _summarize_bots(bots):
+    intervals = [interval for bot in bots for interval in bot.frame_intervals]
+    latencies = [latency for bot in bots for latency in bot.join_latencies]
+    # while in a game, the intervals between games don't count
+    frame_rates = [len(bot.frame_intervals) / sum(bot.frame_intervals) if bot.frame_intervals else 0.0
+                   for bot in bots]
+    bytes_rates = [bot.bytes_received / (bot.stopped_at - bot.started_at) for bot in bots if bot.started_at]
+    jitters = [statistics.pstdev(bot.frame_intervals) for bot in bots if len(bot.frame_intervals) > 1]
+
+    summary = {
+        'clients': len(bots),
+        'disconnected': sum(bot.disconnected for bot in bots),
+        'joined': sum(bool(bot.join_latencies) for bot in bots),
+        'declined': sum(bot.declined for bot in bots),
+        'games_finished': sum(bot.games for bot in bots) // 2,
+        'keys_sent': sum(bot.keys_sent for bot in bots),
+        'frames_per_second_per_client': statistics.mean(frame_rates) if frame_rates else 0.0,
+        'min_frames_per_second': min(frame_rates, default=0.0),
+        'bytes_per_second_per_client': statistics.mean(bytes_rates) if bytes_rates else 0.0,
+        'frame_jitter': statistics.mean(jitters) if jitters else 0.0,
+    }
+    if latencies:
+        summary['join_latency'] = summarize(latencies, unit='join')
+    if intervals:
+        summary['frame_interval'] = summarize(intervals, unit='frame')
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=31425)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help="seconds to measure for, once every bot has connected")
+    parser.add_argument('--ramp-up', type=float, default=5.0,
+                        help="seconds over which the bots connect")
+    parser.add_argument('--key-rate', type=float, default=5.0, help="keys a second per bot")
+    parser.add_argument('--bomb-probability', type=float, default=0.0,
+                        help="chance that a random key plants a bomb")
+    parser.add_argument('--script', help="comma separated keys to press in turn, e.g. up,right,x")
+    parser.add_argument('--spectators', type=int, default=0,
+                        help="bots that watch the first room, on top of --clients")
+    parser.add_argument('--first-room', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    raise_open_files_limit()
+    bots = run_load_test((args.host, args.port), args.clients, args.duration, args.key_rate,
+                         args.bomb_probability, args.script and args.script.split(','),
+                         args.ramp_up, args.first_room, args.seed, args.spectators)
+    summary = summarize_bots(bots)
+
+    def print_summary(summary, indent=''):
+        for key, value in summary.items():
+            if key == 'spectators':
+                print("spectators:")
+                print_summary(value, '  ')
+            elif isinstance(value, dict):
+                print("{}{}: p50 {:.6f}s  p99 {:.6f}s  mean {:.6f}s".format(
+                    indent, key, value['p50'], value['p99'], value['mean']))
+            else:
+                print("{}{}: {}".format(indent, key, value))
+
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(summary, output, indent=2, sort_keys=True)
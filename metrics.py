@@ -0,0 +1,232 @@
+"""
+Server metrics, exposed in the Prometheus text format by MetricsServer.
+
+Code on the hot paths checks `metrics.enabled` before measuring anything,
+so that NullMetrics - the default - costs next to nothing.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TICK_PHASE_SECONDS = 'bomberman_tick_phase_seconds'
+
+
+def _escape_label_value(value):
+    # the backslash first, so that the escapes added after it are kept
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape_label_value(value))
+                          for name, value in labels) + '}'
+
+
+class NullMetrics(object):
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def register_gauge(self, name, function, description=''):
+        pass
+
+    def forget(self, **labels):
+        pass
+
+
+class Metrics(object):
+    """
+    Counters, summaries (count, sum and max of the observed values) and
+    gauges whose values are computed when the metrics are rendered.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._summaries = {}
+        self._gauges = {}
+        # source labels -> {name: (description, values)}, see merge()
+        self._remote_gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                if value > summary[2]:
+                    summary[2] = value
+
+    def register_gauge(self, name, function, description=''):
+        """
+        :param function: returns the value of the gauge or a list of
+                         (labels dict, value) pairs
+        """
+        self._gauges[name] = (function, description)
+
+    def collect(self):
+        """
+        Takes the counters and summaries recorded since the previous call,
+        along with the current values of the gauges, for merge() in
+        another process.
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            summaries, self._summaries = self._summaries, {}
+        gauges = {name: (description, self._gauge_values(function))
+                  for name, (function, description) in self._gauges.items()}
+        return counters, summaries, gauges
+
+    def merge(self, counters, summaries, gauges, **labels):
+        """
+        Adds what another process collect()ed to these metrics.
+        :param labels: added to the gauges, to tell apart those of each process
+        """
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (count, total, maximum) in summaries.items():
+                summary = self._summaries.get(key)
+                if summary is None:
+                    self._summaries[key] = [count, total, maximum]
+                else:
+                    summary[0] += count
+                    summary[1] += total
+                    summary[2] = max(summary[2], maximum)
+            self._remote_gauges[tuple(sorted(labels.items()))] = gauges
+
+    @staticmethod
+    def _gauge_values(function):
+        values = function()
+        if not isinstance(values, list):
+            values = [({}, values)]
+        return values
+
+    def forget(self, **labels):
+        """
+        Drops the counters and summaries of every series with these labels,
+        e.g. those of a room that was closed.
+        """
+        labels = set(labels.items())
+        with self._lock:
+            for series in (self._counters, self._summaries):
+                for key in [key for key in series if labels <= set(key[1])]:
+                    del series[key]
+
+    def render(self):
+        lines = []
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items(), key=lambda item: item[0])
+
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append('# TYPE {} counter'.format(name))
+                last_name = name
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+        maximums = []
+        last_name = None
+        for (name, labels), (count, total, maximum) in summaries:
+            if name != last_name:
+                lines.append('# TYPE {} summary'.format(name))
+                last_name = name
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), total))
+            maximums.append(('{}_max'.format(name), labels, maximum))
+
+        last_name = None
+        for name, labels, maximum in maximums:
+            if name != last_name:
+                lines.append('# TYPE {} gauge'.format(name))
+                last_name = name
+            lines.append('{}{} {}'.format(name, _format_labels(labels), maximum))
+
+        with self._lock:
+            remote_gauges = list(self._remote_gauges.items())
+
+        gauges = {}
+        for name, (function, description) in self._gauges.items():
+            gauges[name] = (description, self._gauge_values(function))
+        for source, source_gauges in remote_gauges:
+            for name, (description, values) in source_gauges.items():
+                _, merged = gauges.setdefault(name, (description, []))
+                merged.extend((dict(labels, **dict(source)), value) for labels, value in values)
+
+        for name, (description, values) in sorted(gauges.items()):
+            if description:
+                lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in values:
+                lines.append('{}{} {}'.format(name, _format_labels(sorted(labels.items())), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class PhaseTimer(object):
+    """
+    Records how long each phase of a tick took, as TICK_PHASE_SECONDS.
+    """
+
+    def __init__(self, metrics, **labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.last_time = None
+
+    def start(self):
+        self.last_time = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.metrics.observe(TICK_PHASE_SECONDS, now - self.last_time, phase=phase, **self.labels)
+        self.last_time = now
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics over HTTP, from a daemon thread.
+    """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path != '/metrics':
+                    handler.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
@@ -0,0 +1,95 @@
+"""
+Client side prediction of the player's own moves.
+
+Every input is sent with a sequence number and a move is applied to the
+predicted position right away, against the blocks of the first board of
+the game - the same checks Player._move makes on the server. The server
+answers with inputack messages carrying the sequence number of the last
+input it handled and the player's position after it; the moves it hasn't
+handled yet are then replayed on top of that position.
+"""
+from game import Block, Player, StringRenderer
+
+MOVES = {
+    'up': (0, -1),
+    'down': (0, 1),
+    'left': (-1, 0),
+    'right': (1, 0),
+}
+
+PLAYER_TILE = ord(StringRenderer.TILE_MAP[Player.OBJECT_NAME])
+BLOCK_TILE = ord(StringRenderer.TILE_MAP[Block.OBJECT_NAME])
+EMPTY_TILE = ord(StringRenderer.EMPTY_TILE)
+
+
+class MovementPredictor(object):
+
+    def __init__(self):
+        self.sequence = 0
+        # (sequence, key) of the moves the server hasn't acknowledged yet
+        self.pending = []
+        self.server_position = None
+        self.position = None
+        self.blocks = frozenset()
+        self.width = None
+        self.height = None
+
+    def on_input(self, key):
+        """
+        :return: the sequence number to send the input with
+        """
+        self.sequence += 1
+        if key in MOVES:
+            self.pending.append((self.sequence, key))
+            if self.position is not None:
+                self.position = self._move(self.position, key)
+        return self.sequence
+
+    def on_ack(self, sequence, position):
+        """
+        :param sequence: the last input the server handled
+        :param position: the player's position after it, None once dead
+        """
+        self.pending = [(pending, key) for pending, key in self.pending if pending > sequence]
+        self.server_position = tuple(position) if position is not None else None
+        self.position = self.server_position
+
+        if self.position is not None:
+            for _, key in self.pending:
+                self.position = self._move(self.position, key)
+
+    def _move(self, position, key):
+        if self.width is None:
+            return position
+
+        x, y = position[0] + MOVES[key][0], position[1] + MOVES[key][1]
+        if not (0 <= x < self.width and 0 <= y < self.height) or (x, y) in self.blocks:
+            return position
+        return x, y
+
+    def _read_blocks(self, tiles, row_length):
+        self.width = row_length - 1
+        self.height = len(tiles) // row_length
+        self.blocks = frozenset(divmod(index, row_length)[::-1]
+                                for index, tile in enumerate(tiles) if tile == BLOCK_TILE)
+
+    def apply(self, board):
+        """
+        :param board: a board received from the server
+        :return: the board with the player drawn at the predicted position
+        """
+        row_length = board.find('\n') + 1 or len(board)
+        if self.width is None:
+            self._read_blocks(board.encode(), row_length)
+
+        if self.position is None or self.position == self.server_position:
+            return board
+
+        tiles = bytearray(board.encode())
+        if self.server_position is not None:
+            x, y = self.server_position
+            if tiles[y * row_length + x] == PLAYER_TILE:
+                tiles[y * row_length + x] = EMPTY_TILE
+        x, y = self.position
+        tiles[y * row_length + x] = PLAYER_TILE
+        return tiles.decode()
@@ -0,0 +1,222 @@
+"""
+Recording and replaying games.
+
+A recording is a file of JSON lines: a header with what Game.start()
+needs, a [frame, [[player, key], ...]] line for every frame on which the
+game handled inputs (player is an index into the header's nicknames) and
+a closing line with the result. The game is deterministic, so running the
+inputs again reproduces it exactly - from a file far smaller than the
+frames it stands for.
+
+    python3 replay.py recordings/20260101-120000-4242-1.replay
+    python3 replay.py recordings/20260101-120000-4242-1.replay --watch
+"""
+import argparse
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+from game import Game
+
+VERSION = 1
+
+
+class RecordingWriter(object):
+    """
+    Writes the recordings of all the rooms from a daemon thread; a tick
+    only puts its inputs on a queue.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.queue = queue.SimpleQueue()
+        self._files = {}
+        self._names = itertools.count(1)
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def open(self, game, nicknames, **metadata):
+        """
+        Starts the recording of a game that is about to start.
+        :param metadata: stored in the header, e.g. the room number
+        :return: a GameRecorder to be set as game.recorder
+        """
+        name = '{}-{}-{}.replay'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid(), next(self._names))
+        path = os.path.join(self.directory, name)
+
+        header = {
+            'version': VERSION,
+            'fps': game.clock.fps,
+            'width': game.width,
+            'height': game.height,
+            'nicknames': list(nicknames),
+        }
+        header.update(metadata)
+        self.write(path, header)
+        return GameRecorder(self, path, nicknames)
+
+    def write(self, path, record):
+        self.queue.put((path, record))
+
+    def close(self, path):
+        self.queue.put((path, None))
+
+    def run(self):
+        while True:
+            path, record = self.queue.get()
+            recording = self._files.get(path)
+
+            if record is None:
+                if recording:
+                    recording.close()
+                    del self._files[path]
+                continue
+
+            if recording is None:
+                recording = self._files[path] = open(path, 'a')
+            recording.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+class GameRecorder(object):
+    """
+    Collects the inputs a game handles on a frame into a single record.
+    """
+
+    def __init__(self, writer, path, nicknames):
+        self.writer = writer
+        self.path = path
+        self.players = {nickname: index for index, nickname in enumerate(nicknames)}
+        self.frame_number = None
+        self.inputs = []
+
+    def record(self, frame_number, nickname, key_name):
+        if frame_number != self.frame_number:
+            self._flush()
+            self.frame_number = frame_number
+        self.inputs.append([self.players[nickname], key_name])
+
+    def _flush(self):
+        if self.inputs:
+            self.writer.write(self.path, [self.frame_number, self.inputs])
+            self.inputs = []
+
+    def finish(self, frame_number, winner):
+        self._flush()
+        self.writer.write(self.path, {'frames': frame_number, 'winner': winner})
+        self.writer.close(self.path)
+
+    def abort(self):
+        """
+        Closes a recording that won't get a result, as if it was cut short.
+        """
+        self._flush()
+        self.writer.close(self.path)
+
+
+class Replay(object):
+    """
+    A loaded recording.
+    """
+
+    def __init__(self, header, inputs, result=None):
+        """
+        :param inputs: a dict of the (nickname, key_name) pairs of every frame
+        :param result: the closing record, None if the recording was cut short
+        """
+        self.header = header
+        self.inputs = inputs
+        self.result = result
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as recording:
+            header = json.loads(next(recording))
+            nicknames = header['nicknames']
+            inputs = {}
+            result = None
+
+            for line in recording:
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    result = record
+                    continue
+                frame_number, frame_inputs = record
+                inputs[frame_number] = [(nicknames[player], key_name) for player, key_name in frame_inputs]
+
+        return cls(header, inputs, result)
+
+    @property
+    def frames(self):
+        if self.result:
+            return self.result['frames']
+        return max(self.inputs, default=0)
+
+    def get_key_presses(self, game):
+        return self.inputs.get(game.frame_number + 1, ())
+
+    def create_game(self):
+        game = Game(self.header['fps'], self.header['width'], self.header['height'])
+        game.start(self.header['nicknames'])
+        return game
+
+    def run(self, render=False):
+        """
+        Re-simulates the game as fast as possible.
+        :return: the game, after the last recorded frame
+        """
+        game = self.create_game()
+        game.advance(self.frames, self.get_key_presses, render)
+        return game
+
+    def watch(self, renderer):
+        """
+        Re-plays the game at its own speed, drawing every frame.
+        :param renderer: e.g. a ConsoleRenderer
+        """
+        game = self.create_game()
+        game.clock.start()
+
+        while game.is_running and game.frame_number < self.frames:
+            for nickname, key_name in self.get_key_presses(game):
+                game.on_player_key_press(nickname, key_name)
+            game.process_loop_once()
+            renderer.render(game.rendered_board)
+
+        return game
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording')
+    parser.add_argument('--watch', action='store_true', help="play the game in the terminal")
+    args = parser.parse_args()
+
+    replay = Replay.load(args.recording)
+
+    if args.watch:
+        from consolerenderer import ConsoleRenderer
+        console = ConsoleRenderer()
+        try:
+            game = replay.watch(console)
+        finally:
+            console.end()
+        duration = None
+    else:
+        start_time = time.perf_counter()
+        game = replay.run()
+        duration = time.perf_counter() - start_time
+
+    print("frames: {}".format(game.frame_number))
+    print("winner: {}".format(game.winner))
+    if replay.result:
+        print("matches the recording: {}".format(
+            (game.frame_number, game.winner) == (replay.result['frames'], replay.result['winner'])))
+    if duration:
+        print("ticks_per_second: {}".format(game.frame_number / duration))
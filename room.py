@@ -1,18 +1,48 @@
-import threading
-from time import sleep
+import logging
+from time import monotonic
 
+from frames import FrameEncoder
 from game import Game
+from metrics import PhaseTimer
+from serverlog import EventCounter
+
+log = logging.getLogger(__name__)
+key_presses = EventCounter(log, "key presses")
 
 
 class Room:
+    PRELUDE_DELAY = 1
+    START_DELAY = 3
+
     def __init__(self, server, room_number):
-        print("Launching a room")
+        log.info("Launching room %s", room_number)
         self.player_count = 0
         self.players = []
+        # clients watching the game, they get every broadcast but no inputack
+        self.spectators = []
         self.game_state = 0
         self.game = Game()
+        self.frame_encoder = FrameEncoder()
+        # the last (sequence, position) acknowledged to every player
+        self.input_acks = {}
         self.server = server
         self.room_number = room_number
+        self._stage = self._run_prelude
+
+        if server.metrics.enabled:
+            self.game.phase_timer = PhaseTimer(server.metrics, room=room_number)
+
+    @property
+    def recipients(self):
+        return self.players + self.spectators
+
+    @property
+    def ticks(self):
+        return self.game.clock.ticks
+
+    @property
+    def tick_overruns(self):
+        return self.game.clock.overruns
 
     def AddPlayer(self, player):
         if self.player_count not in (0, 1):
@@ -22,37 +52,78 @@ class Room:
         self.players.append(player)
         self.player_count += 1
         if self.player_count == 2:
-            thread = threading.Thread(target=self.run, args=())
-            thread.start()
+            log.info("Running the game in room %s", self.room_number)
+            self.server.scheduler.schedule(self, monotonic() + self.PRELUDE_DELAY)
         return True
 
+    def AddSpectator(self, player):
+        self.spectators.append(player)
+        return True
+
+    def RemoveSpectator(self, player):
+        if player in self.spectators:
+            self.spectators.remove(player)
+        self.frame_encoder.forget(player)
+
     def DeletePlayer(self, player):
         if player in self.players:
             self.players.remove(player)
             self.player_count -= 1
             self.game_state = 0
+        self.frame_encoder.forget(player)
+        self.input_acks.pop(player, None)
 
-    def run(self):
-        print("Running the game.")
-        sleep(1)
-        self.notify_game_prelude()
-        sleep(3)
-        print("The game has begun")
+    def tick(self, deadline):
+        """
+        Called by the RoomScheduler whenever the room is due.
+        :param deadline: the time at which the tick was scheduled
+        :return: the deadline of the next tick or None when the game is over
+        """
+        try:
+            return self._stage(deadline)
+        finally:
+            self.server.FlushPlayers(self.recipients)
 
-        self.game.start([player.nickname for player in self.players])
+    def _run_prelude(self, deadline):
+        self.notify_game_prelude()
+        self._stage = self._start_game
+        return deadline + self.START_DELAY
+
+    def _start_game(self, deadline):
+        log.info("The game in room %s has begun", self.room_number)
+        nicknames = [player.nickname for player in self.players]
+        if self.server.recordings:
+            self.game.recorder = self.server.recordings.open(self.game, nicknames, room=self.room_number)
+        self.game.start(nicknames)
         self.notify_game_start()
+        self.game.clock.start(deadline)
+        self._stage = self._run_game
+        return deadline
+
+    def _run_game(self, deadline):
+        next_deadline = self.game.clock.tick()
+        self.game.step()
+        self.notify_input_acks()
+        self.notify_board(self.game.rendered_board)
+        if self.game.phase_timer:
+            self.game.phase_timer.lap('broadcast')
 
-        while self.game.is_running:
-            self.game.process_loop_once()
-            self.notify_game_state({
-                'board': self.game.rendered_board,
-            })
+        if not self.game.is_running:
+            self.notify_game_result(self.game.winner)
+            return None
 
-        self.notify_game_result(list(self.game.players.keys())[0])
+        return next_deadline
 
     # Game -> Player
     def message_players(self, action, data):
-        self.server.SendMessageToPlayers(self.players, action, data)
+        """
+        Sends the message to the players and the spectators, encoded once.
+        """
+        self.record_bytes_sent(self.server.SendMessageToPlayers(self.recipients, action, data))
+
+    def record_bytes_sent(self, sent):
+        if self.server.metrics.enabled:
+            self.server.metrics.inc('bomberman_room_bytes_sent_total', sent, room=self.room_number)
 
     def notify_game_prelude(self):
         self.message_players("gameprelude", {})
@@ -61,24 +132,78 @@ class Room:
         self.game_state = True
         self.message_players("gamestart", {})
 
-    def notify_game_state(self, state):
+    def notify_board(self, board):
         """
-        :param state: a map that will later be rendered by the Client
+        Sends the rendered board as a keyframe or as a delta against the
+        frame each player or spectator already has; every distinct message
+        is encoded once, however many clients it goes to.
+        :param board: the rendered board
         :return: None
         """
-        self.message_players("display_board", state)
+        recipients = []
+        for client in self.recipients:
+            if self.server.IsLagging(client):
+                # it will need the whole of whichever board it gets next
+                self.frame_encoder.request_keyframe(client)
+            else:
+                recipients.append(client)
+
+        for players, frame in self.frame_encoder.encode(board, recipients):
+            self.record_bytes_sent(self.server.SendMessageToPlayers(players, "display_board", frame))
+
+    def notify_input_acks(self):
+        """
+        Tells the players that number their inputs which one was handled
+        last and where that left them, whenever that changes.
+        """
+        for player in list(self.players):
+            sequence = self.game.input_sequences.get(player.nickname)
+            if sequence is None:
+                continue
+
+            game_player = self.game.players.get(player.nickname)
+            position = game_player.position if game_player else None
+            if self.input_acks.get(player) == (sequence, position):
+                continue
+
+            self.input_acks[player] = (sequence, position)
+            self.record_bytes_sent(self.server.SendMessageToPlayers([player], "inputack", {
+                'seq': sequence,
+                'position': list(position) if position else None,
+            }))
 
     def notify_game_result(self, winner):
         self.game_state = False
+        if self.game.recorder:
+            self.game.recorder.finish(self.game.frame_number, winner)
         self.message_players("gameresult", {'winner': winner, 'loser': ''})
         self.server.DeleteRoom(self.room_number)
 
+    def abort(self):
+        """
+        Ends the game without a winner and closes the room, e.g. when a
+        tick failed.
+        """
+        self.game_state = False
+        if self.game.recorder:
+            self.game.recorder.abort()
+        self.message_players("gameresult", {'winner': None, 'loser': ''})
+        self.server.FlushPlayers(self.recipients)
+        if self.server.rooms.get(self.room_number) is self:
+            self.server.DeleteRoom(self.room_number)
+
     # Player -> Game
-    def Input(self, player, key):
+    def Input(self, player, key, sequence=None):
         """
         :param player: Client
         :param key: 
+        :param sequence: the client's sequence number of the input, if any
         :return: 
         """
-        print("Player {} has pressed key {}".format(player.nickname, key))
-        self.game.on_player_key_press(player.nickname, key)
+        if player not in self.players or key not in self.game.KEY_ACTION_MAPPING:
+            return
+        key_presses.add(self.room_number, key)
+        self.game.on_player_key_press(player.nickname, key, sequence)
+
+    def RequestKeyframe(self, player):
+        self.frame_encoder.request_keyframe(player)
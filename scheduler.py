@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RoomScheduler(object):
+    """
+    Drives the ticks of all rooms from a single thread.
+
+    Rooms are kept in a heap ordered by the time at which they are due.
+    Every due room gets its tick(deadline) called, which returns the
+    deadline of its next tick or None once the room is done. A room whose
+    tick raised is logged and abort()ed.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def next_deadline(self):
+        with self._condition:
+            return self._heap[0][0] if self._heap else None
+
+    def schedule(self, room, deadline):
+        """
+        :param room: an object with a tick(deadline) method and an abort()
+                     method, called instead once a tick raised
+        :param deadline: time.monotonic() at which the room should tick
+        :return: None
+        """
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), room))
+            self._condition.notify()
+
+    def _pop_due(self, now):
+        with self._condition:
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            return heapq.heappop(self._heap)
+
+    def run_due(self):
+        """
+        Ticks every room that is due at the time of the call.
+        :return: the number of ticked rooms
+        """
+        now = time.monotonic()
+        ticked = 0
+
+        while True:
+            entry = self._pop_due(now)
+            if entry is None:
+                return ticked
+
+            deadline, _, room = entry
+            try:
+                next_deadline = room.tick(deadline)
+            except Exception:
+                log.exception("The tick of room %s failed", getattr(room, 'room_number', room))
+                self._abort(room)
+                next_deadline = None
+
+            ticked += 1
+            if next_deadline is not None:
+                self.schedule(room, next_deadline)
+
+    @staticmethod
+    def _abort(room):
+        try:
+            room.abort()
+        except Exception:
+            log.exception("Closing room %s failed", getattr(room, 'room_number', room))
+
+    def run(self):
+        while True:
+            self.run_due()
+
+            with self._condition:
+                if not self._heap:
+                    self._condition.wait()
+                else:
+                    timeout = self._heap[0][0] - time.monotonic()
+                    if timeout > 0:
+                        self._condition.wait(timeout)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+
+class AsyncRoomScheduler(RoomScheduler):
+    """
+    Drives the rooms from a task of the running asyncio event loop, so that
+    rooms tick on the same thread that owns the connections.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._wakeup = None
+        self._task = None
+
+    def schedule(self, room, deadline):
+        super().schedule(room, deadline)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_async(self):
+        self._wakeup = asyncio.Event()
+
+        while True:
+            self._wakeup.clear()
+            self.run_due()
+
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                await asyncio.sleep(0)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run_async())
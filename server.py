@@ -1,22 +1,78 @@
+import logging
+import socket
 import sys
-from collections import defaultdict
-from time import sleep, localtime
+from collections import defaultdict, deque
+from time import monotonic, sleep, localtime
 from weakref import WeakKeyDictionary
 
 from PodSixNet.Server import Server
 from PodSixNet.Channel import Channel
+from PodSixNet.asyncwrapper import asynchat
+from PodSixNet.rencode import dumps
+from frames import FRAME_FORMATS, STRING_FORMAT
+from metrics import Metrics, MetricsServer, NullMetrics
+from game import Bomb
 from room import Room
+from scheduler import RoomScheduler
+from serverlog import dropped_records, setup_logging
 
+log = logging.getLogger(__name__)
 
-class ClientChannel(Channel):
+
+def register_game_gauges(metrics, get_rooms):
     """
-    This is the server representation of a single connected client.
+    The gauges of the games, in the process that runs them.
+    :param get_rooms: returns a list of the (room_number, room) pairs
     """
+    metrics.register_gauge('bomberman_room_input_queue_depth', lambda: [
+        ({'room': number}, len(room.game.input_queue))
+        for number, room in get_rooms() if hasattr(room, 'game')
+    ], "players with actions waiting for the next tick")
+    metrics.register_gauge('bomberman_room_inputs_coalesced', lambda: [
+        ({'room': number}, room.game.input_queue.coalesced)
+        for number, room in get_rooms() if hasattr(room, 'game')
+    ], "actions dropped because the player had too many waiting")
+    metrics.register_gauge('bomberman_room_ticks', lambda: [
+        ({'room': number}, room.ticks)
+        for number, room in get_rooms() if hasattr(room, 'game')
+    ])
+    metrics.register_gauge('bomberman_room_tick_overruns', lambda: [
+        ({'room': number}, room.tick_overruns)
+        for number, room in get_rooms() if hasattr(room, 'game')
+    ])
+    metrics.register_gauge('bomberman_object_pool', lambda: [
+        ({'object': object_class.OBJECT_NAME, 'stat': stat}, value)
+        for object_class in (Bomb,)
+        for stat, value in object_class.pool.stats.items()
+    ], "allocation statistics of the pooled game objects")
 
-    def __init__(self, *args, **kwargs):
+
+class ClientChannelHandlers(object):
+    """
+    The Network_* handlers of a connected client, shared by the
+    PodSixNet and the asyncio server engines.
+    """
+
+    def __init__(self):
         self.nickname = "anonymous"
         self.room_number = None
-        Channel.__init__(self, *args, **kwargs)
+        self.delta_frames = False
+        self.frame_format = STRING_FORMAT
+        # encoded messages of the current tick, see Flush()
+        self.outbox = []
+        # when the client fell too far behind to be sent frames, see IsLagging()
+        self.lagging_since = None
+
+    def QueueBytes(self, payload):
+        self.outbox.append(payload)
+
+    def Flush(self):
+        """
+        Sends everything queued during the tick as a single write.
+        """
+        if self.outbox:
+            outbox, self.outbox = self.outbox, []
+            self.SendBytes(b''.join(outbox))
 
     def Close(self):
         self._server.DelPlayer(self)
@@ -24,80 +80,322 @@ class ClientChannel(Channel):
     def Network_message(self, data):
         self._server.SendToAll({"action": "message", "message": data['message'], "who": self.nickname})
 
+    def Network_hello(self, data):
+        self.delta_frames = data.get('delta', False)
+        self.frame_format = next((frame_format for frame_format in data.get('formats', ())
+                                  if frame_format in FRAME_FORMATS), STRING_FORMAT)
+
     def Network_nickname(self, data):
         self.nickname = data['nickname']
 
     def Network_join_room(self, data):
         room = data['room']
-        self._server.AddPlayerToRoom(self, room)
+        if data.get('watch'):
+            self._server.AddSpectatorToRoom(self, room)
+        else:
+            self._server.AddPlayerToRoom(self, room)
 
     def Network_input(self, data):
         if self.room_number is not None:
             self._server.PassInputToRoom(self, data)
 
+    def Network_request_keyframe(self, data):
+        if self.room_number is not None:
+            self._server.PassKeyframeRequestToRoom(self)
+
+
+class ClientChannel(ClientChannelHandlers, Channel):
+    """
+    This is the server representation of a single connected client.
+    """
 
-class BombermanServer(Server):
     def __init__(self, *args, **kwargs):
-        Server.__init__(self, *args, **kwargs)
+        ClientChannelHandlers.__init__(self)
+        Channel.__init__(self, *args, **kwargs)
+        # appended to by the room thread, drained by Pump() in the main one
+        self.sendqueue = deque()
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def SendBytes(self, data):
+        self.sendqueue.append(data)
+
+    def Pump(self):
+        """
+        Hands everything queued since the last call to the socket at once.
+        """
+        data = []
+        while self.sendqueue:
+            data.append(self.sendqueue.popleft())
+        if data:
+            asynchat.async_chat.push(self, b''.join(data))
+
+
+class BombermanServerBase(object):
+    """
+    Rooms and players, independent of the network engine serving them.
+    """
+
+    scheduler_class = RoomScheduler
+    endchars = b'\0---\0'
+    # a client with more bytes than this waiting to be sent gets no frames
+    MAX_OUTBOUND_BYTES = 64 * 1024
+
+    def __init__(self, metrics=None, recordings=None, slow_client_timeout=None):
+        """
+        :param recordings: a replay.RecordingWriter, to record every game
+        :param slow_client_timeout: seconds after which a client that is
+                                    still too far behind is disconnected,
+                                    None to keep it
+        """
         self.players = WeakKeyDictionary()
-        self.channelClass = ClientChannel
         # Each room should contain a dict of (room_number -> Room)"""
         self.rooms = defaultdict(lambda: Room())
+        self.scheduler = self.scheduler_class()
+        self.metrics = metrics or NullMetrics()
+        self.recordings = recordings
+        self.slow_client_timeout = slow_client_timeout
+        # clients to be disconnected by the thread that owns the sockets
+        self.slow_clients = set()
+        self._register_gauges()
+
+    def _get_rooms(self):
+        return list(self.rooms.items())
+
+    def _register_gauges(self):
+        metrics = self.metrics
+        metrics.register_gauge('bomberman_rooms', lambda: len(self.rooms), "open rooms")
+        metrics.register_gauge('bomberman_rooms_playing', lambda: sum(
+            bool(room.game_state) for _, room in self._get_rooms()), "rooms with a game in progress")
+        metrics.register_gauge('bomberman_players', lambda: len(self.players), "connected clients")
+        metrics.register_gauge('bomberman_scheduled_rooms', lambda: len(self.scheduler),
+                               "rooms waiting in the scheduler")
+        metrics.register_gauge('bomberman_room_outbound_queue_bytes', lambda: [
+            ({'room': number}, sum(self.OutboundQueueBytes(player) for player in room.recipients))
+            for number, room in self._get_rooms()
+        ], "bytes waiting to be sent to the players and spectators of a room")
+        metrics.register_gauge('bomberman_lagging_clients', lambda: sum(
+            player.lagging_since is not None for player in list(self.players)),
+            "clients too far behind to be sent frames")
+        metrics.register_gauge('bomberman_room_spectators', lambda: [
+            ({'room': number}, len(room.spectators)) for number, room in self._get_rooms()
+        ], "clients watching a room")
+        metrics.register_gauge('bomberman_log_records_dropped', dropped_records,
+                               "log records dropped because the log writer fell behind")
+        self._register_game_gauges()
 
-        print('Server launched')
+    def _register_game_gauges(self):
+        register_game_gauges(self.metrics, self._get_rooms)
+
+    def OutboundQueueBytes(self, player):
+        return sum(map(len, list(player.sendqueue))) + sum(map(len, list(player.producer_fifo)))
+
+    def IsLagging(self, player):
+        """
+        Whether the player has too much waiting to be sent to get another
+        frame. Frames aren't queued behind each other for a slow client: it
+        skips them and gets a keyframe of the latest board once it has
+        caught up. Other messages are always queued, in order.
+        """
+        if player not in self.players:
+            # disconnected, but its room hasn't let go of it yet
+            return True
+
+        if self.OutboundQueueBytes(player) <= self.MAX_OUTBOUND_BYTES:
+            player.lagging_since = None
+            return False
+
+        now = monotonic()
+        if player.lagging_since is None:
+            player.lagging_since = now
+        elif (self.slow_client_timeout is not None
+              and now - player.lagging_since > self.slow_client_timeout
+              and player not in self.slow_clients):
+            log.warning("Disconnecting %s, it has been lagging for %.1fs",
+                        player.addr, now - player.lagging_since)
+            self.metrics.inc('bomberman_slow_client_disconnects_total')
+            self.DisconnectPlayer(player)
+
+        self.metrics.inc('bomberman_frames_dropped_total', room=player.room_number)
+        return True
+
+    def DisconnectPlayer(self, player):
+        self.slow_clients.add(player)
+
+    def CloseSlowClients(self):
+        while self.slow_clients:
+            channel = self.slow_clients.pop()
+            # what's still queued will never be sent
+            channel.sendqueue.clear()
+            channel.discard_buffers()
+            if channel in self.players:
+                channel.handle_close()
 
     def Connected(self, channel, addr):
         self.AddPlayer(channel)
 
+    def CreateRoom(self, room_number):
+        return Room(self, room_number)
+
     def AddPlayerToRoom(self, player, room_number):
+        if not self._leave_room(player, room_number):
+            return
         if room_number not in self.rooms:
-            self.rooms[room_number] = Room(self, room_number)
+            self.rooms[room_number] = self.CreateRoom(room_number)
         if self.rooms[room_number].AddPlayer(player):
-            print("Granting access for {} to join room {}".format(player, room_number))
+            log.info("Granting access for %s to join room %s", player.nickname, room_number)
             player.room_number = room_number
             player.Send({'action': 'joinedroom', 'room_number': room_number})
 
         else:
             player.Send({'action': 'declinedroom', 'room_number': room_number})
-            print("Declining access")
+            log.info("Declining access for %s to room %s", player.nickname, room_number)
+
+    def AddSpectatorToRoom(self, player, room_number):
+        if not self._leave_room(player, room_number):
+            return
+        if room_number not in self.rooms:
+            self.rooms[room_number] = self.CreateRoom(room_number)
+        self.rooms[room_number].AddSpectator(player)
+        log.info("%s is watching room %s", player.nickname, room_number)
+        player.room_number = room_number
+        player.Send({'action': 'joinedroom', 'room_number': room_number, 'spectating': True})
+
+    def _leave_room(self, player, room_number):
+        """
+        Stops the player watching its current room before it joins another
+        one; a player that is playing can't leave its game.
+        :return: whether the player may join `room_number`
+        """
+        room = self.rooms.get(player.room_number)
+        if room and player in room.players:
+            log.info("Declining access for %s to room %s, it's playing in room %s",
+                     player.nickname, room_number, player.room_number)
+            player.Send({'action': 'declinedroom', 'room_number': room_number})
+            return False
+
+        self.StopWatching(player)
+        return True
+
+    def StopWatching(self, player):
+        room = self.rooms.get(player.room_number)
+        if room and player in room.spectators:
+            room.RemoveSpectator(player)
+            player.room_number = None
 
     def AddPlayer(self, player):
-        print("New Player joined: " + str(player.addr))
+        log.info("New player joined: %s", player.addr)
         self.players[player] = True
-        print("players", [p.nickname for p in self.players])
+        log.debug("players: %s", [p.nickname for p in self.players])
 
     def PassInputToRoom(self, player, data):
+        key, sequence = data.get('key'), data.get('seq')
+        if not isinstance(key, str):
+            return
+        if not isinstance(sequence, int) or isinstance(sequence, bool):
+            # the input still counts, it just won't be acknowledged
+            sequence = None
+
         room = self.rooms[player.room_number]
         if room.game_state:
-            key = data['key']
-            self.rooms[player.room_number].Input(player, key)
+            room.Input(player, key, sequence)
+
+    def PassKeyframeRequestToRoom(self, player):
+        room = self.rooms.get(player.room_number)
+        if room:
+            room.RequestKeyframe(player)
 
     def SendMessageToPlayers(self, players, action, data):
+        """
+        Encodes the message once and queues it for the players, until
+        FlushPlayers() is called at the end of the tick.
+        :return: the number of bytes queued
+        """
         message = {'action': action}
         message.update(data)
-        # print(message)
+        payload = dumps(message) + self.endchars
         for player in players:
-            player.Send(message)
+            player.QueueBytes(payload)
+        return len(payload) * len(players)
 
-    def DelPlayer(self, player):
-        print("Deleting Player" + str(player.addr))
-        del self.players[player]
+    def SendToAll(self, data):
+        for player in list(self.players):
+            player.Send(data)
 
+    def FlushPlayers(self, players):
+        for player in players:
+            player.Flush()
 
+    def DelPlayer(self, player):
+        log.info("Deleting player %s", player.addr)
+        del self.players[player]
+        self.StopWatching(player)
 
     def DeleteRoom(self, room_number):
-        for player in self.rooms[room_number].players:
+        for player in self.rooms[room_number].recipients:
             if player.room_number == room_number:
                 player.room_number = None
         del self.rooms[room_number]
+        self.metrics.forget(room=room_number)
+
+
+class BombermanServer(BombermanServerBase, Server):
+    def __init__(self, *args, metrics=None, recordings=None, slow_client_timeout=None, **kwargs):
+        Server.__init__(self, *args, **kwargs)
+        BombermanServerBase.__init__(self, metrics, recordings, slow_client_timeout)
+        self.channelClass = ClientChannel
+
+        log.info('Server launched')
 
     def Launch(self):
+        self.scheduler.start()
         while True:
             self.Pump()
+            self.CloseSlowClients()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--port', type=int, default=31425)
+    parser.add_argument('--asyncio', action='store_true',
+                        help="serve the clients from an asyncio event loop")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="run the rooms in this many worker processes")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics on localhost:PORT/metrics")
+    parser.add_argument('--record', metavar='DIRECTORY',
+                        help="record the inputs of every game for replay.py")
+    parser.add_argument('--slow-client-timeout', type=float, metavar='SECONDS',
+                        help="disconnect clients that are too far behind for this long")
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
 
+    metrics = None
+    if args.metrics_port:
+        metrics = Metrics()
+        MetricsServer(metrics, args.metrics_port).start()
 
-host = "localhost"
-port = 31425
-s = BombermanServer(localaddr=(host, port))
-s.Launch()
+    recordings = None
+    if args.record:
+        from replay import RecordingWriter
+        recordings = RecordingWriter(args.record)
+        recordings.start()
 
+    if args.asyncio:
+        from asyncserver import AsyncBombermanServer
+        s = AsyncBombermanServer(localaddr=(args.host, args.port), metrics=metrics,
+                                 recordings=recordings, slow_client_timeout=args.slow_client_timeout)
+    elif args.processes:
+        from sharding import ShardedBombermanServer
+        s = ShardedBombermanServer(localaddr=(args.host, args.port), workers=args.processes,
+                                   metrics=metrics, recordings=recordings,
+                                   slow_client_timeout=args.slow_client_timeout)
+    else:
+        s = BombermanServer(localaddr=(args.host, args.port), metrics=metrics, recordings=recordings,
+                            slow_client_timeout=args.slow_client_timeout)
+    s.Launch()
@@ -0,0 +1,135 @@
+"""
+Logging for the server that never blocks the room threads or the Pump loop.
+
+setup_logging() routes the records of the standard logging module into a
+bounded queue, and a daemon thread writes them out. If the writer falls
+behind - e.g. stdout is a slow pipe - the records that don't fit in the
+queue are dropped and counted instead of stalling a tick.
+
+Events too frequent to log one by one, like key presses, are counted by an
+EventCounter and logged as a summary every SUMMARY_INTERVAL seconds.
+"""
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+
+QUEUE_SIZE = 10000
+SUMMARY_INTERVAL = 10.0
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_counters = []
+_handler = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that drops the record when the queue is full.
+    """
+
+    def __init__(self, record_queue):
+        logging.handlers.QueueHandler.__init__(self, record_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class EventCounter(object):
+    """
+    Counts events by key and logs how many of each happened since the
+    previous summary.
+    """
+
+    def __init__(self, logger, description, level=logging.INFO):
+        """
+        :param description: what is counted, e.g. "key presses"
+        """
+        self.logger = logger
+        self.description = description
+        self.level = level
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        _counters.append(self)
+
+    def add(self, *key):
+        with self._lock:
+            self._counts[key] += 1
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s: %s", self.description, ' '.join(map(str, key)))
+
+    def flush(self, interval):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+
+        if counts and self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "%d %s in the last %.0fs: %s",
+                            sum(counts.values()), self.description, interval,
+                            ', '.join('{}={}'.format(' '.join(map(str, key)), count)
+                                      for key, count in sorted(counts.items())))
+
+
+class LogWriter(object):
+    """
+    Writes the queued records with `handler` from a daemon thread.
+    """
+
+    def __init__(self, record_queue, handler, interval=SUMMARY_INTERVAL):
+        self.queue = record_queue
+        self.handler = handler
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        last_summary = time.monotonic()
+
+        while True:
+            timeout = last_summary + self.interval - time.monotonic()
+            try:
+                record = self.queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                record = None
+
+            if record is not None:
+                self.handler.handle(record)
+
+            now = time.monotonic()
+            if now - last_summary >= self.interval:
+                for counter in list(_counters):
+                    counter.flush(now - last_summary)
+                last_summary = now
+
+
+def setup_logging(level=logging.INFO, stream=None):
+    """
+    Sends the records of every logger to `stream` (stdout by default)
+    through the queue and the writer thread.
+    """
+    global _handler
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT))
+
+    record_queue = queue.Queue(QUEUE_SIZE)
+    _handler = DroppingQueueHandler(record_queue)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_handler)
+
+    LogWriter(record_queue, handler).start()
+
+
+def dropped_records():
+    return _handler.dropped if _handler else 0
@@ -0,0 +1,343 @@
+"""
+Runs the rooms in several worker processes, so that the simulation isn't
+limited to the single core a GIL-bound interpreter can use.
+
+The front process accepts the connections, as BombermanServer does, and
+routes each room number to one of the workers. A worker runs the Game
+loops of its rooms and streams the already encoded messages back to the
+front process, which only has to copy them to the client sockets.
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+import zlib
+from time import monotonic
+
+from PodSixNet.rencode import dumps
+
+from metrics import Metrics, NullMetrics
+from room import Room
+from scheduler import RoomScheduler
+from replay import RecordingWriter
+from server import BombermanServer, register_game_gauges
+from serverlog import setup_logging
+
+log = logging.getLogger(__name__)
+
+
+class RemotePlayer(object):
+    """
+    A worker's view of a client connected to the front process.
+    """
+
+    def __init__(self, channel_id, nickname, delta_frames, frame_format):
+        self.channel_id = channel_id
+        self.nickname = nickname
+        self.delta_frames = delta_frames
+        self.frame_format = frame_format
+        self.room_number = None
+
+
+class WorkerServer(object):
+    """
+    Plays the part of BombermanServer for the rooms of a single worker.
+    """
+
+    endchars = b'\0---\0'
+    # seconds between two reports of the metrics to the front process
+    METRICS_INTERVAL = 1.0
+
+    def __init__(self, inbox, outbox, recordings=None, metrics=None, shard=0):
+        """
+        :param metrics: a Metrics, reported to the front process to be served
+        :param shard: the worker's number, which its metrics are reported with
+        """
+        self.shard = shard
+        self.inbox = inbox
+        self.outbox = outbox
+        self.rooms = {}
+        self.players = {}
+        self.scheduler = RoomScheduler()
+        self.metrics = metrics or NullMetrics()
+        self.recordings = recordings
+        # keeps the reports in order with the 'closed' messages
+        self._report_lock = threading.Lock()
+
+        register_game_gauges(self.metrics, lambda: list(self.rooms.items()))
+
+    def SendMessageToPlayers(self, players, action, data):
+        message = {'action': action}
+        message.update(data)
+        payload = dumps(message) + self.endchars
+        is_frame = action == 'display_board'
+        self.outbox.put(('send', [player.channel_id for player in players], payload, is_frame))
+        return len(payload) * len(players)
+
+    def IsLagging(self, player):
+        # the front process drops the frames of the clients that lag behind
+        return False
+
+    def FlushPlayers(self, players):
+        # the front process joins what it has for a channel before writing it
+        pass
+
+    def DeleteRoom(self, room_number):
+        room = self.rooms.pop(room_number)
+        for player in room.recipients:
+            self.players.pop(player.channel_id, None)
+        with self._report_lock:
+            # the front process forgets the room's metrics once it's closed
+            self._report_metrics()
+            self.outbox.put(('closed', room_number))
+
+    def ReportMetrics(self):
+        with self._report_lock:
+            self._report_metrics()
+
+    def _report_metrics(self):
+        if self.metrics.enabled:
+            self.outbox.put(('metrics', self.shard) + self.metrics.collect())
+
+    def _add_remote_player(self, room_number, channel_id, nickname, delta_frames, frame_format):
+        player = RemotePlayer(channel_id, nickname, delta_frames, frame_format)
+        player.room_number = room_number
+        self.players[channel_id] = player
+        return player
+
+    def start_room(self, room_number, players, spectators=()):
+        room = Room(self, room_number)
+        self.rooms[room_number] = room
+
+        for player in players:
+            room.AddPlayer(self._add_remote_player(room_number, *player))
+        for spectator in spectators:
+            room.AddSpectator(self._add_remote_player(room_number, *spectator))
+
+    def add_spectator(self, room_number, spectator):
+        room = self.rooms.get(room_number)
+        if room:
+            room.AddSpectator(self._add_remote_player(room_number, *spectator))
+
+    def remove_spectator(self, room_number, channel_id):
+        room = self.rooms.get(room_number)
+        player = self.players.pop(channel_id, None)
+        if room and player:
+            room.RemoveSpectator(player)
+
+    def input(self, channel_id, key, sequence=None):
+        player = self.players.get(channel_id)
+        room = player and self.rooms.get(player.room_number)
+        if room and room.game_state:
+            room.Input(player, key, sequence)
+
+    def request_keyframe(self, channel_id):
+        player = self.players.get(channel_id)
+        room = player and self.rooms.get(player.room_number)
+        if room:
+            room.RequestKeyframe(player)
+
+    def run(self):
+        self.scheduler.start()
+        next_report = monotonic() + self.METRICS_INTERVAL
+
+        while True:
+            if monotonic() >= next_report:
+                self.ReportMetrics()
+                next_report = monotonic() + self.METRICS_INTERVAL
+            try:
+                command, *args = self.inbox.get(timeout=self.METRICS_INTERVAL)
+            except queue.Empty:
+                continue
+            if command == 'stop':
+                return
+            try:
+                getattr(self, command)(*args)
+            except Exception:
+                # a bad message must not take the other rooms of the worker down with it
+                log.exception("Worker command %s failed", command)
+
+
+def run_worker(inbox, outbox, log_level=logging.INFO, recordings_directory=None, metrics=False, shard=0):
+    """
+    :param metrics: whether to measure and report the metrics of the rooms
+    """
+    setup_logging(log_level)
+
+    recordings = None
+    if recordings_directory:
+        recordings = RecordingWriter(recordings_directory)
+        recordings.start()
+
+    WorkerServer(inbox, outbox, recordings, Metrics() if metrics else None, shard).run()
+
+
+class RoomProxy(object):
+    """
+    The front process' view of a room that lives in a worker.
+    """
+
+    def __init__(self, server, room_number, worker):
+        self.server = server
+        self.room_number = room_number
+        self.worker = worker
+        self.players = []
+        self.spectators = []
+        self.game_state = False
+
+    @property
+    def recipients(self):
+        return self.players + self.spectators
+
+    @staticmethod
+    def _describe(player):
+        return id(player), player.nickname, player.delta_frames, player.frame_format
+
+    def AddPlayer(self, player):
+        if len(self.players) >= 2:
+            return False
+
+        self.players.append(player)
+        if len(self.players) == 2:
+            self.game_state = True
+            self.worker.put(('start_room', self.room_number,
+                             [self._describe(player) for player in self.players],
+                             [self._describe(spectator) for spectator in self.spectators]))
+        return True
+
+    def AddSpectator(self, player):
+        self.spectators.append(player)
+        if self.game_state:
+            self.worker.put(('add_spectator', self.room_number, self._describe(player)))
+        return True
+
+    def RemoveSpectator(self, player):
+        if player in self.spectators:
+            self.spectators.remove(player)
+            if self.game_state:
+                self.worker.put(('remove_spectator', self.room_number, id(player)))
+
+    def Input(self, player, key, sequence=None):
+        self.worker.put(('input', id(player), key, sequence))
+
+    def RequestKeyframe(self, player):
+        if self.game_state:
+            self.worker.put(('request_keyframe', id(player)))
+
+
+class ShardedBombermanServer(BombermanServer):
+    """
+    A BombermanServer whose rooms run in `workers` worker processes.
+    """
+
+    # seconds between two checks that the workers are alive
+    WORKER_CHECK_INTERVAL = 1.0
+
+    def __init__(self, *args, workers=None, **kwargs):
+        BombermanServer.__init__(self, *args, **kwargs)
+        self.worker_count = workers or multiprocessing.cpu_count()
+        self.workers = []
+        self.outbox = None
+        self.processes = []
+        self.channels_by_id = {}
+        self.context = None
+        self.next_worker_check = 0
+
+    def _get_worker(self, room_number):
+        shard = zlib.crc32(str(room_number).encode()) % len(self.workers)
+        return self.workers[shard]
+
+    def Connected(self, channel, addr):
+        self.channels_by_id[id(channel)] = channel
+        BombermanServer.Connected(self, channel, addr)
+
+    def DelPlayer(self, player):
+        self.channels_by_id.pop(id(player), None)
+        BombermanServer.DelPlayer(self, player)
+
+    def CreateRoom(self, room_number):
+        return RoomProxy(self, room_number, self._get_worker(room_number))
+
+    def _register_game_gauges(self):
+        # the games run in the workers, whose gauges come with their metrics
+        pass
+
+    def _start_worker(self, shard):
+        inbox = self.context.Queue()
+        recordings_directory = self.recordings.directory if self.recordings else None
+        process = self.context.Process(target=run_worker, daemon=True,
+                                       args=(inbox, self.outbox, logging.getLogger().level,
+                                             recordings_directory, self.metrics.enabled, shard))
+        process.start()
+        return inbox, process
+
+    def start_workers(self):
+        self.context = multiprocessing.get_context('spawn')
+        self.outbox = self.context.Queue()
+
+        for shard in range(self.worker_count):
+            inbox, process = self._start_worker(shard)
+            self.workers.append(inbox)
+            self.processes.append(process)
+
+    def CheckWorkers(self):
+        """
+        Replaces the workers that died. The games running in them are lost,
+        so their players are told the game is over; the rooms that are
+        still waiting for players move to the new worker.
+        """
+        now = monotonic()
+        if now < self.next_worker_check:
+            return
+        self.next_worker_check = now + self.WORKER_CHECK_INTERVAL
+
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+
+            log.error("Worker %s exited with code %s, restarting it", shard, process.exitcode)
+            dead_inbox = self.workers[shard]
+            self.workers[shard], self.processes[shard] = self._start_worker(shard)
+
+            for room_number, room in self._get_rooms():
+                if room.worker is not dead_inbox:
+                    continue
+                if not room.game_state:
+                    room.worker = self.workers[shard]
+                else:
+                    self.SendMessageToPlayers(room.recipients, 'gameresult', {'winner': None, 'loser': ''})
+                    self.FlushPlayers(room.recipients)
+                    self.DeleteRoom(room_number)
+
+    def PumpWorkers(self):
+        while True:
+            try:
+                message = self.outbox.get_nowait()
+            except queue.Empty:
+                return
+
+            if message[0] == 'send':
+                _, channel_ids, payload, is_frame = message
+                for channel_id in channel_ids:
+                    channel = self.channels_by_id.get(channel_id)
+                    if channel is None:
+                        continue
+                    if is_frame and self.IsLagging(channel):
+                        # the worker's next frame for the channel will be a keyframe
+                        self.PassKeyframeRequestToRoom(channel)
+                        continue
+                    channel.sendqueue.append(payload)
+            elif message[0] == 'metrics':
+                _, shard, counters, summaries, gauges = message
+                self.metrics.merge(counters, summaries, gauges, worker=shard)
+            elif message[0] == 'closed':
+                if message[1] in self.rooms:
+                    self.DeleteRoom(message[1])
+
+    def Launch(self):
+        self.start_workers()
+        while True:
+            self.PumpWorkers()
+            self.CheckWorkers()
+            self.Pump()
+            self.CloseSlowClients()
@@ -0,0 +1,58 @@
+import heapq
+import itertools
+
+
+class TimingWheel(object):
+    """
+    Events scheduled for future frames.
+
+    The wheel has a slot for each of the next `size` frames, so scheduling
+    and firing an event are O(1) and a frame without events costs nothing
+    but an empty list check. Events further away wait in a heap until they
+    come within reach of the wheel.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        self.frame_number = 0
+        self.overflow = []
+        self._sequence = itertools.count()
+        self.scheduled = 0
+
+    def __len__(self):
+        return self.scheduled
+
+    def schedule(self, frame_number, function, argument):
+        """
+        Makes advance() return (function, argument) on frame `frame_number`,
+        or on the next frame if that one has already passed.
+        """
+        frame_number = max(frame_number, self.frame_number + 1)
+        self.scheduled += 1
+
+        if frame_number - self.frame_number >= self.size:
+            heapq.heappush(self.overflow, (frame_number, next(self._sequence), function, argument))
+        else:
+            self.slots[frame_number % self.size].append((function, argument))
+
+    def advance(self, frame_number):
+        """
+        :return: the (function, argument) events due up to `frame_number`
+        """
+        due = []
+
+        while self.frame_number < frame_number:
+            self.frame_number += 1
+
+            while self.overflow and self.overflow[0][0] - self.frame_number < self.size:
+                event_frame, _, function, argument = heapq.heappop(self.overflow)
+                self.slots[event_frame % self.size].append((function, argument))
+
+            slot = self.slots[self.frame_number % self.size]
+            if slot:
+                due += slot
+                slot.clear()
+
+        self.scheduled -= len(due)
+        return due